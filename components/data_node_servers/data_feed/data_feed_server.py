@@ -2,25 +2,592 @@
 # Modified work Copyright (c) 2018-2019 Simons Observatory Collaboration
 # Please refer to licensing information in the root of this repository.
 
+import os
 import sys
+import copy
+import shutil
 import time
+import queue
+import threading
 import numpy as np
 
 from os import environ
 
-from twisted.internet import reactor, threads
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 
-from autobahn.wamp.types import ComponentConfig
+from autobahn.wamp.types import ComponentConfig, SubscribeOptions
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
 
 import sisock
 
 
+class _Buffer(object):
+    """Timestamps of a single OCS block, and the data of each of its
+    channels, in preallocated numpy arrays.
+
+    The channels of a block share its timestamps, which are stored once.
+    Samples are appended at the end of the arrays and evicted from the start,
+    so the buffered samples are always the contiguous slice between the two.
+    When the arrays fill up, the buffered samples are copied to the start of
+    new arrays, doubled in size if they are more than half full, so appending
+    and evicting are both amortized O(1) per sample.
+
+    Buffered samples are never modified in place, so a snapshot() stays
+    valid while more samples are added, and can be read from another thread.
+
+    Parameters
+    ----------
+    capacity : int
+        initial number of samples the arrays can hold
+
+    """
+    def __init__(self, capacity=1024):
+        self._t = np.empty(capacity)
+        self._data = {}
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def channels(self):
+        """Names of the channels in the block."""
+        return list(self._data.keys())
+
+    @property
+    def time(self):
+        """Buffered timestamps, a view into the buffer."""
+        return self._t[self._start:self._end]
+
+    def data(self, channel):
+        """Buffered data of a channel, a view into the buffer."""
+        return self._data[channel][self._start:self._end]
+
+    def extend(self, timestamps, data):
+        """Append samples to the buffer, keeping it sorted by time.
+
+        Channels missing from data, or new to the block, are NaN where they
+        have no samples. Samples are expected in time order, any which aren't
+        are sorted into place, at a cost proportional to how far back they
+        go.
+
+        Parameters
+        ----------
+        timestamps : list
+            unix timestamps of the samples
+        data : dict
+            values of the samples of each channel
+
+        """
+        n = len(timestamps)
+        if n == 0:
+            return
+        if self._end + n > len(self._t):
+            self._make_room(n)
+
+        for channel in data:
+            if channel not in self._data:
+                self._data[channel] = np.full(len(self._t), np.nan)
+
+        self._t[self._end:self._end + n] = timestamps
+        for channel, array in self._data.items():
+            array[self._end:self._end + n] = data.get(channel, np.nan)
+        self._end += n
+
+        # Sort any samples which arrived out of order into place, in new
+        # arrays, as the samples before them may be in a snapshot.
+        new = self._t[self._end - n:self._end]
+        if np.any(new[1:] < new[:-1]) or new[0] < self._t[max(self._end - n - 1, self._start)]:
+            first = self._start + int(np.searchsorted(self._t[self._start:self._end - n],
+                                                      new.min(), side='right'))
+            order = np.argsort(self._t[first:self._end], kind='mergesort') + first
+            self._t = self._t.copy()
+            self._t[first:self._end] = self._t[order]
+            for channel, array in list(self._data.items()):
+                array = array.copy()
+                array[first:self._end] = array[order]
+                self._data[channel] = array
+
+    def _make_room(self, n):
+        """Copy the buffered samples to the start of new arrays, large enough
+        that at most half is used after appending n more samples."""
+        size = len(self)
+        capacity = len(self._t)
+        while size + n > capacity // 2:
+            capacity *= 2
+
+        def move(array):
+            new = np.empty(capacity)
+            new[:size] = array[self._start:self._end]
+            return new
+
+        self._t = move(self._t)
+        self._data = {channel: move(array) for channel, array in self._data.items()}
+        self._start = 0
+        self._end = size
+
+    def slice(self, start, end):
+        """Find the buffered samples within a time range, by binary search.
+
+        Returns
+        -------
+        slice
+            slice of time and data() selecting samples with start <= t <= end,
+            to take views of them without copying
+
+        """
+        t = self.time
+        return slice(int(np.searchsorted(t, start, side='left')),
+                     int(np.searchsorted(t, end, side='right')))
+
+    def window(self, start, end, channels):
+        """Buffered samples with start <= t <= end.
+
+        Returns
+        -------
+        tuple
+            timestamps, and a list of the data of each of channels, as views
+            of the buffer
+
+        """
+        idx = self.slice(start, end)
+        return self.time[idx], [self.data(channel)[idx] for channel in channels]
+
+    def snapshot(self):
+        """A copy of the buffer, sharing its arrays, which is unaffected by
+        samples added or evicted later."""
+        snapshot = copy.copy(self)
+        snapshot._data = dict(self._data)
+        return snapshot
+
+    def evict(self, cutoff):
+        """Drop samples with timestamps before cutoff."""
+        self._start += int(np.searchsorted(self.time, cutoff, side='left'))
+
+
+class _DiskBuffer(object):
+    """Timestamps of a single OCS block, and the data of each of its
+    channels, in append-only files on disk, read through memory maps.
+
+    Samples are stored in segments, directories each covering up to
+    segment_time seconds, holding a file of float64 timestamps, "t", and one
+    for each channel, "data/<channel>". Files are only ever appended to, and
+    whole segments are deleted once all their samples are older than the
+    eviction cutoff, so a snapshot() stays valid while samples are added, and
+    only the pages a query reads are held in memory.
+
+    Opening an existing directory recovers the samples stored in it, e.g.
+    after a restart. Any samples only partially written when the previous
+    process stopped are discarded.
+
+    Parameters
+    ----------
+    directory : str
+        directory holding the segments of the block, created if needed
+    segment_time : float
+        time span, in seconds, of each segment
+
+    """
+    def __init__(self, directory, segment_time):
+        self.directory = directory
+        self.segment_time = segment_time
+        # (name, first timestamp, last timestamp, samples, channels) of each
+        # segment, oldest first. Replaced, never mutated, when the last
+        # segment grows.
+        self._segments = []
+        # Open files of the last segment, to append to.
+        self._files = {}
+        self._cutoff = -np.inf
+        # Number of the next segment. Names are never reused, as a snapshot
+        # may still list an evicted segment.
+        self._next_segment = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            self._next_segment = max(self._next_segment, int(name) + 1)
+            self._recover(name)
+
+    def _path(self, name, channel=None):
+        if channel is None:
+            return os.path.join(self.directory, name, 't')
+        return os.path.join(self.directory, name, 'data', channel)
+
+    def _recover(self, name):
+        """Reopen a segment, truncating its files to the samples which were
+        completely written."""
+        data_dir = os.path.join(self.directory, name, 'data')
+        channels = sorted(os.listdir(data_dir)) if os.path.isdir(data_dir) else []
+        paths = [self._path(name)] + [self._path(name, c) for c in channels]
+        try:
+            n = min(os.path.getsize(path) for path in paths) // 8
+        except OSError:
+            n = 0
+        if n == 0:
+            shutil.rmtree(os.path.join(self.directory, name))
+            return
+
+        for path in paths:
+            os.truncate(path, n * 8)
+        t = np.memmap(self._path(name), dtype=np.float64, mode='r', shape=(n,))
+        self._segments.append((name, float(t[0]), float(t[-1]), n, tuple(channels)))
+
+    @property
+    def channels(self):
+        """Names of the channels in the block."""
+        channels = set()
+        for segment in self._segments:
+            channels.update(segment[4])
+        return list(channels)
+
+    def extend(self, timestamps, data):
+        """Append samples to the buffer, keeping it sorted by time.
+
+        Channels missing from data, or new to the block, are NaN where they
+        have no samples. As the files are append-only, samples older than the
+        last one stored are dropped.
+
+        Parameters
+        ----------
+        timestamps : list
+            unix timestamps of the samples
+        data : dict
+            values of the samples of each channel
+
+        """
+        t = np.asarray(timestamps, dtype=np.float64)
+        order = np.argsort(t, kind='mergesort')
+        if self._segments:
+            order = order[t[order] >= self._segments[-1][2]]
+            if len(order) < len(t):
+                print("Dropped {} samples older than those stored in {}".format(
+                    len(t) - len(order), self.directory))
+        if len(order) == 0:
+            return
+        t = t[order]
+        data = {channel: np.broadcast_to(np.asarray(array, dtype=np.float64),
+                                         (len(timestamps),))[order]
+                for channel, array in data.items()}
+
+        # Split the samples at segment boundaries.
+        i = 0
+        while i < len(t):
+            if not self._segments or t[i] - self._segments[-1][1] >= self.segment_time:
+                self._new_segment(t[i])
+            j = int(np.searchsorted(t, self._segments[-1][1] + self.segment_time,
+                                    side='left'))
+            self._append(t[i:j], {channel: array[i:j] for channel, array in data.items()})
+            i = j
+
+    def _new_segment(self, first):
+        """Start a new segment, to append samples from time first to."""
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+        name = '{:010d}'.format(self._next_segment)
+        self._next_segment += 1
+        os.makedirs(os.path.join(self.directory, name, 'data'))
+        self._segments.append((name, float(first), float(first), 0, ()))
+
+    def _open(self, name, channel=None):
+        if channel not in self._files:
+            self._files[channel] = open(self._path(name, channel), 'ab')
+        return self._files[channel]
+
+    def _append(self, t, data):
+        """Append sorted samples to the last segment, timestamps last, so
+        they are only counted on recovery once all channels are written."""
+        name, first, _, n, old_channels = self._segments[-1]
+        channels = tuple(sorted(set(old_channels) | set(data)))
+
+        for channel in channels:
+            f = self._open(name, channel)
+            if channel not in old_channels and n:
+                f.write(np.full(n, np.nan).tobytes())
+            f.write(data.get(channel, np.full(len(t), np.nan)).tobytes())
+            f.flush()
+        f = self._open(name)
+        f.write(t.tobytes())
+        f.flush()
+
+        self._segments[-1] = (name, first, float(t[-1]), n + len(t), channels)
+
+    def window(self, start, end, channels):
+        """Buffered samples with start <= t <= end.
+
+        Returns
+        -------
+        tuple
+            timestamps, and a list of the data of each of channels, read from
+            the segments overlapping the time range
+
+        """
+        start = max(start, self._cutoff)
+        times = []
+        columns = [[] for _ in channels]
+
+        for name, first, last, n, segment_channels in self._segments:
+            if n == 0 or last < start or first > end:
+                continue
+            try:
+                t = np.memmap(self._path(name), dtype=np.float64, mode='r', shape=(n,))
+                idx = slice(int(np.searchsorted(t, start, side='left')),
+                            int(np.searchsorted(t, end, side='right')))
+                segment_columns = [
+                    np.memmap(self._path(name, channel), dtype=np.float64,
+                              mode='r', shape=(n,))[idx]
+                    if channel in segment_channels else
+                    np.full(idx.stop - idx.start, np.nan)
+                    for channel in channels]
+            except FileNotFoundError:
+                # Evicted since the snapshot was taken.
+                continue
+            times.append(t[idx])
+            for column, segment_column in zip(columns, segment_columns):
+                column.append(segment_column)
+
+        if not times:
+            return np.empty(0), [np.empty(0) for _ in channels]
+        return np.concatenate(times), [np.concatenate(column) for column in columns]
+
+    def snapshot(self):
+        """A copy of the buffer, sharing its files, which is unaffected by
+        samples added later."""
+        snapshot = copy.copy(self)
+        snapshot._segments = list(self._segments)
+        snapshot._files = {}
+        return snapshot
+
+    def evict(self, cutoff):
+        """Drop samples with timestamps before cutoff, deleting the segments
+        which hold only such samples."""
+        self._cutoff = cutoff
+        while self._segments and self._segments[0][2] < cutoff:
+            name = self._segments.pop(0)[0]
+            if not self._segments:
+                for f in self._files.values():
+                    f.close()
+                self._files = {}
+            shutil.rmtree(os.path.join(self.directory, name))
+
+
+class _Rollup(object):
+    """Minimum, maximum and mean of the channels of a block over fixed
+    intervals, built incrementally as samples are added.
+
+    Intervals are aligned to multiples of interval in unix time. Each is
+    reduced to a single sample at its midpoint, with channels
+    "<channel>.min", "<channel>.max" and "<channel>.mean", which is added to
+    the buffer once a sample after the interval arrives. Samples arriving
+    after their interval was added are left out.
+
+    Parameters
+    ----------
+    interval : float
+        length of the intervals, in seconds
+    buffer : _Buffer or _DiskBuffer
+        buffer to add the reduced intervals to
+
+    """
+    def __init__(self, interval, buffer):
+        self.interval = interval
+        self.buffer = buffer
+        # Index of the interval still open, and the minimum, maximum, sum and
+        # number of non-NaN samples of each channel within it.
+        self._open = None
+        self._acc = {}
+
+    def extend(self, timestamps, data):
+        """Add samples to the intervals they fall in, adding the intervals
+        completed to the buffer.
+
+        Parameters
+        ----------
+        timestamps : list
+            unix timestamps of the samples
+        data : dict
+            values of the samples of each channel
+
+        """
+        t = np.asarray(timestamps, dtype=np.float64)
+        order = np.argsort(t, kind='mergesort')
+        keys = np.floor(t[order] / self.interval)
+        if self._open is not None:
+            order, keys = order[keys >= self._open], keys[keys >= self._open]
+        if len(order) == 0:
+            return
+
+        # Reduce the samples of each interval.
+        first = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+        intervals = keys[first]
+        stats = {}
+        for channel, array in data.items():
+            y = np.broadcast_to(np.asarray(array, dtype=np.float64), t.shape)[order]
+            valid = ~np.isnan(y)
+            stats[channel] = [np.fmin.reduceat(y, first),
+                              np.fmax.reduceat(y, first),
+                              np.add.reduceat(np.where(valid, y, 0.), first),
+                              np.add.reduceat(valid.astype(np.float64), first)]
+
+        # Combine them with the open interval.
+        empty = (np.nan, np.nan, 0., 0.)
+        merge = self._open is not None and intervals[0] == self._open
+        prepend = self._open is not None and not merge
+        for channel in set(stats) | set(self._acc):
+            s = stats.get(channel) or [np.full(len(first), x) for x in empty]
+            acc = self._acc.get(channel, empty)
+            if merge:
+                s[0][0] = np.fmin(s[0][0], acc[0])
+                s[1][0] = np.fmax(s[1][0], acc[1])
+                s[2][0] += acc[2]
+                s[3][0] += acc[3]
+            elif prepend:
+                s = [np.concatenate(([x], y)) for x, y in zip(acc, s)]
+            stats[channel] = s
+        if prepend:
+            intervals = np.concatenate(([self._open], intervals))
+
+        # All but the last interval are complete.
+        if len(intervals) > 1:
+            closed = {}
+            for channel, (_min, _max, total, count) in stats.items():
+                closed[channel + '.min'] = _min[:-1]
+                closed[channel + '.max'] = _max[:-1]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    closed[channel + '.mean'] = total[:-1] / count[:-1]
+            self.buffer.extend((intervals[:-1] + 0.5) * self.interval, closed)
+
+        self._open = intervals[-1]
+        self._acc = {channel: tuple(x[-1] for x in s) for channel, s in stats.items()}
+
+    def window(self, start, end, channels, extremes=False):
+        """Reduced intervals with midpoints start <= t <= end.
+
+        Parameters
+        ----------
+        start : float
+        end : float
+        channels : list
+            names of the channels to return
+        extremes : bool
+            if True, each interval is returned as two samples, its minimum
+            and its maximum, a quarter of an interval either side of its
+            midpoint, rather than as its mean
+
+        Returns
+        -------
+        tuple
+            timestamps, and a list of the data of each of channels
+
+        """
+        if not extremes:
+            return self.buffer.window(start, end, [c + '.mean' for c in channels])
+
+        t, columns = self.buffer.window(
+            start, end, [c + s for c in channels for s in ('.min', '.max')])
+        _t = np.stack((t - self.interval / 4, t + self.interval / 4), axis=1).ravel()
+        _columns = [np.stack((_min, _max), axis=1).ravel()
+                    for _min, _max in zip(columns[::2], columns[1::2])]
+        return _t, _columns
+
+    def snapshot(self):
+        """A copy of the rollup, sharing its buffer's snapshot."""
+        snapshot = copy.copy(self)
+        snapshot.buffer = self.buffer.snapshot()
+        snapshot._acc = dict(self._acc)
+        return snapshot
+
+    def evict(self, cutoff):
+        """Drop intervals with midpoints before cutoff."""
+        self.buffer.evict(cutoff)
+
+
+def _downsample(t, columns, stride):
+    """Downsample channels sharing a timeline, keeping their extremes.
+
+    Samples are grouped into buckets 2 * stride wide. Each bucket is reduced
+    to two samples, at the times of its first and last samples, holding the
+    minimum and maximum of each channel within it, in the order they
+    occurred. This keeps spikes which plain decimation would miss, with
+    samples stride apart on average.
+
+    Parameters
+    ----------
+    t : numpy.ndarray
+        sorted timestamps
+    columns : list
+        numpy.ndarray of data for each channel, the same length as t
+    stride : float
+        minimum average separation of samples, in seconds
+
+    Returns
+    -------
+    tuple
+        (t, columns) downsampled, or unchanged if already sparse enough.
+
+    """
+    if len(t) == 0:
+        return t, columns
+
+    bins = np.floor(t / (2 * stride))
+    first = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    if 2 * len(first) >= len(t):
+        return t, columns
+
+    last = np.concatenate((first[1:], [len(t)])) - 1
+    counts = last - first + 1
+    position = np.arange(len(t))
+
+    # Buckets with a single sample are only output once.
+    keep = np.stack((np.ones(len(first), dtype=bool), counts > 1), axis=1).ravel()
+    _t = np.stack((t[first], t[last]), axis=1).ravel()[keep]
+
+    _columns = []
+    for y in columns:
+        _min = np.fmin.reduceat(y, first)
+        _max = np.fmax.reduceat(y, first)
+
+        # Position of the first minimum and maximum of each bucket.
+        at_min = np.minimum.reduceat(
+            np.where(y == np.repeat(_min, counts), position, len(t)), first)
+        at_max = np.minimum.reduceat(
+            np.where(y == np.repeat(_max, counts), position, len(t)), first)
+        min_first = at_min <= at_max
+
+        _y = np.stack((np.where(min_first, _min, _max),
+                       np.where(min_first, _max, _min)), axis=1).ravel()[keep]
+        _columns.append(_y)
+
+    return _t, _columns
+
+
+def _as_list(names):
+    """Split a comma separated list of names, or None if any name is to be
+    matched, given as '*'."""
+    if names is None or not isinstance(names, str):
+        names = [names]
+    else:
+        names = [name.strip() for name in names.split(',')]
+    if '*' in names:
+        return None
+    return names
+
+
 class data_feed_server(sisock.base.DataNodeServer):
-    """A data server that subscribes to a single ocs data feed address,
-    recieves and caches data published to that feed, and returns that data when
-    queried.
+    """A data server that subscribes to ocs data feed addresses, recieves and
+    caches data published to those feeds, and returns that data when queried.
+
+    Several targets and feeds can be served by one server. Data from every
+    combination of target and feed given is cached, with separate buffers for
+    each block of each feed of each target. When more than one target may be
+    served, field names are prefixed by the target, i.e.
+    "LSA22HA.channel_01_r". When more than one feed may be served, field
+    names are also prefixed by the feed, i.e. "LSA22HA.temperatures.channel_01_r",
+    and timelines are named "observatory.TARGET.feeds.FEED.BLOCK" rather than
+    "observatory.TARGET.BLOCK", so that blocks of the same name in different
+    feeds are kept apart.
 
     Parameters
     ----------
@@ -30,26 +597,73 @@ class data_feed_server(sisock.base.DataNodeServer):
         sisock data server name, used within sisock
     description : str
         sisock data server description, used within sisock
-    feed : str
-        ocs registered feed name i.e. 'temperatures', used for subscribing to
-        feed for data collection and caching
-    target : str
-        ocs agent target, i.e. "LSA22HA", used to assemble the complete
-        crossbar address for subscribing to a feed for data collection
+    feed : str or list
+        ocs registered feed name i.e. 'temperatures', or a list of them, used
+        for subscribing to feeds for data collection and caching. '*'
+        subscribes to any feed.
+    target : str or list
+        ocs agent target, i.e. "LSA22HA", or a list of them, used to assemble
+        the complete crossbar addresses for subscribing to feeds for data
+        collection. '*' subscribes to any target.
     buffer_time : int
         amount of time, in seconds, to buffer data for live monitor
+    buffer_directory : str
+        directory to keep the buffer in, on disk, with _DiskBuffer, so it
+        survives restarts. If None, the buffer is kept in memory.
+    rollups : list
+        (interval, keep_time) pairs, in seconds. For each, the minimum,
+        maximum and mean of each channel over intervals of that length are
+        kept for keep_time, with _Rollup, to serve data older than
+        buffer_time at lower resolution.
 
     """
-    data = {}
-
     def __init__(self, config, name, description, feed, target=None,
-                 buffer_time=3600):
+                 buffer_time=3600, buffer_directory=None, rollups=()):
         ApplicationSession.__init__(self, config)
-        self.target = target
+        self.targets = _as_list(target)
         self.name = name
         self.description = description
         self.buffer_time = buffer_time
-        self.feed = feed
+        self.buffer_directory = buffer_directory
+        self.rollups = sorted(rollups)
+        self.feeds = _as_list(feed)
+
+        # Whether field names need the target, and the feed, to be unique.
+        self.prefix_target = self.targets is None or len(self.targets) > 1
+        self.prefix_feed = self.feeds is None or len(self.feeds) > 1
+
+        # Buffers for each (target, feed, block), their rollups, and the
+        # (target, feed, block) and channel name of each field. Only the
+        # ingest thread touches these, see _ingest_loop().
+        self.data = {}
+        self.rollup_data = {}
+        self.blocks = {}
+
+        # Reopen the blocks buffered on disk by a previous run.
+        if buffer_directory is not None:
+            os.makedirs(buffer_directory, exist_ok=True)
+            for target in self.targets or sorted(os.listdir(buffer_directory)):
+                target_directory = os.path.join(buffer_directory, target)
+                if not os.path.isdir(target_directory):
+                    continue
+                for feed in self.feeds or sorted(os.listdir(target_directory)):
+                    directory = os.path.join(target_directory, feed)
+                    if not os.path.isdir(directory):
+                        continue
+                    for block in sorted(os.listdir(directory)):
+                        # Rollups are kept alongside, see _add_block().
+                        if '@' not in block:
+                            self._add_block((target, feed, block))
+
+        # Snapshots of data, rollup_data and blocks, published by the ingest
+        # thread after each batch, for queries to read. Replaced, never
+        # mutated.
+        self._publish()
+
+        # Messages received, with the time they arrived, their target and
+        # feed, waiting to be ingested.
+        self._ingest_queue = queue.Queue()
+        threading.Thread(target=self._ingest_loop, daemon=True).start()
 
     # Need to overload onConnect and onChallenge to get ws connection over port
     # 8001 to crossbar
@@ -60,16 +674,25 @@ class data_feed_server(sisock.base.DataNodeServer):
     def onChallenge(self, challenge):
         self.log.info('authentication challenge received')
 
+    def _topics(self):
+        """Topics to subscribe to, as (uri, match) pairs.
+
+        Any target or feed is matched by an empty component in a wildcard
+        subscription, i.e. 'observatory..feeds.temperatures'.
+        """
+        topics = []
+        for target in self.targets or ['']:
+            for feed in self.feeds or ['']:
+                match = u'wildcard' if '' in (target, feed) else u'exact'
+                topics.append((u'observatory.{}.feeds.{}'.format(target, feed), match))
+        return topics
+
     @inlineCallbacks
     def after_onJoin(self, details):
         print("session attached")
 
-        print('targeting observatory.{}.feeds.{}'.format(self.target,
-                                                         self.feed))
-
-        @inlineCallbacks
         def cache_data(subscription_message):
-            """Cache data from an OCS data feed.
+            """Queue data from an OCS data feed to be cached.
 
             Parameters
             ----------
@@ -80,86 +703,254 @@ class data_feed_server(sisock.base.DataNodeServer):
             """
             message, feed_data = subscription_message
 
-            # Check we're a DataNodeServer for the correct Agent.
-            if feed_data['agent_address'] == 'observatory.{}'.format(self.target):
-                yield threads.deferToThread(self.extend_data, message)
-                print("Received published data from feed: " +
-                      "observatory.{}.feeds.{}".format(self.target, self.feed))
+            # Check we're a DataNodeServer for the correct Agent and feed.
+            address = feed_data['agent_address']
+            if not address.startswith('observatory.'):
+                return
+            target = address[len('observatory.'):]
+            feed = feed_data['feed_name']
+            if self.targets is not None and target not in self.targets:
+                return
+            if self.feeds is not None and feed not in self.feeds:
+                return
+            self._ingest_queue.put((time.time(), target, feed, message))
+
+        for topic_uri, match in self._topics():
+            print('targeting {}'.format(topic_uri))
+            yield self.subscribe(cache_data, topic_uri,
+                                 options=SubscribeOptions(match=match))
+
+    def _ingest_loop(self, report_interval=60):
+        """Cache queued messages, for the lifetime of the server. Runs in its
+        own thread, the only one to modify the buffers.
+
+        Messages are drained from the queue in batches, and a snapshot of the
+        buffers is published after each batch. The delay between messages
+        arriving and being published is reported every report_interval
+        seconds.
+
+        """
+        messages = 0
+        max_lag = 0
+        t_report = time.time()
+        topics = ', '.join(uri for uri, _ in self._topics())
 
-        topic_uri = u'observatory.{}.feeds.{}'.format(self.target, self.feed)
-        yield self.subscribe(cache_data, topic_uri)
+        while True:
+            batch = [self._ingest_queue.get()]
+            while True:
+                try:
+                    batch.append(self._ingest_queue.get_nowait())
+                except queue.Empty:
+                    break
 
-    def extend_data(self, message):
+            for _, target, feed, message in batch:
+                try:
+                    self.extend_data(message, target, feed)
+                except Exception as e:
+                    self.log.error("Could not cache message: {e}", e=e)
+
+            # Clear data from buffer.
+            now = time.time()
+            for key, buff in self.data.items():
+                buff.evict(now - self.buffer_time)
+                self._evict_rollups(key, now)
+
+            self._publish()
+
+            messages += len(batch)
+            max_lag = max(max_lag, time.time() - batch[0][0])
+            if time.time() - t_report > report_interval:
+                self.log.info("Cached {n} messages from {topics}, "
+                              "max ingest lag {lag:.3f} s, {q} queued",
+                              n=messages, topics=topics,
+                              lag=max_lag, q=self._ingest_queue.qsize())
+                messages = 0
+                max_lag = 0
+                t_report = time.time()
+
+    def _publish(self):
+        """Publish a snapshot of the buffers for queries."""
+        self.snapshot = ({key: buff.snapshot() for key, buff in self.data.items()},
+                         {key: [rollup.snapshot() for rollup in rollups]
+                          for key, rollups in self.rollup_data.items()},
+                         dict(self.blocks))
+
+    def _field_name(self, key, channel_name):
+        """The sisock field name of a channel of a (target, feed, block)."""
+        target, feed, _ = key
+        parts = [target] if self.prefix_target else []
+        if self.prefix_feed:
+            parts.append(feed)
+        return '.'.join(parts + [channel_name])
+
+    def _timeline_name(self, key):
+        """The sisock timeline name of a (target, feed, block)."""
+        target, feed, block = key
+        if self.prefix_feed:
+            return 'observatory.{}.feeds.{}.{}'.format(target, feed, block)
+        return 'observatory.{}.{}'.format(target, block)
+
+    def _block_directory(self, key, suffix=''):
+        target, feed, block = key
+        return os.path.join(self.buffer_directory, target, feed, block + suffix)
+
+    def _add_block(self, key):
+        """Start buffering a (target, feed, block), on disk in
+        "<target>/<feed>/<block>" under buffer_directory if one was given,
+        reopening anything buffered there already.
+
+        Buffers on disk have segments a tenth of the time they're kept for,
+        so at most about a tenth more than that is kept.
+        """
+        if self.buffer_directory is None:
+            buff = _Buffer()
+        else:
+            buff = _DiskBuffer(self._block_directory(key),
+                               segment_time=max(self.buffer_time / 10, 60))
+
+        # A _Rollup for each interval in rollups, on disk alongside, in
+        # "<block>@<interval>".
+        rollups = []
+        for interval, keep_time in self.rollups:
+            if self.buffer_directory is None:
+                rollup_buff = _Buffer()
+            else:
+                rollup_buff = _DiskBuffer(
+                    self._block_directory(key, '@{:g}'.format(interval)),
+                    segment_time=max(keep_time / 10, 60))
+            rollups.append(_Rollup(interval, rollup_buff))
+
+        self.data[key] = buff
+        self.rollup_data[key] = rollups
+
+        now = time.time()
+        buff.evict(now - self.buffer_time)
+        self._evict_rollups(key, now)
+        for channel_name in buff.channels:
+            self.blocks[self._field_name(key, channel_name)] = (key, channel_name)
+
+    def _evict_rollups(self, key, now):
+        for rollup, (_, keep_time) in zip(self.rollup_data[key], self.rollups):
+            rollup.evict(now - keep_time)
+
+    def extend_data(self, message, target, feed):
         """Extend data in the cache recieved in message.
 
-        This operation was slow enough to cause issues when run in the reactor
-        thread. Be sure to call with deferToThread().
+        Only to be called from the ingest thread, see _ingest_loop().
 
         Parameters
         ----------
         message
             message from OCS subscription feed. See OCS Feed documentation for
             message structure.
+        target : str
+            ocs agent target which published the message
+        feed : str
+            ocs feed the message was published to
 
         """
         for block, value in message.items():
+            key = (target, feed, block)
+            if key not in self.data:
+                self._add_block(key)
+
+            # Cache latest data points, with the timestamps stored once for
+            # all channels in the block.
+            data = {}
             for channel, data_array in value['data'].items():
                 channel_name = channel.lower().replace(' ', '_')
+                data[channel_name] = data_array
+                self.blocks[self._field_name(key, channel_name)] = (key, channel_name)
 
-                if channel_name not in self.data.keys():
-                    self.data[channel_name] = {"time": [], "data": []}
-
-                # Cache latest data point.
-                self.data[channel_name]['data'].extend(value['data'][channel])
-                # This could be improved. We're caching a copy of the
-                # timestamps array for each channel, which is
-                # inefficient for the 240s, but used to make sense in
-                # the old feed scheme
-                self.data[channel_name]['time'].extend(value['timestamps'])
-
-                # Clear data from buffer.
-                buff_idx = sum(time.time() -
-                               np.array(self.data[channel_name]['time']) > self.buffer_time)
-                self.data[channel_name]['time'] = self.data[channel_name]['time'][buff_idx:]
-                self.data[channel_name]['data'] = self.data[channel_name]['data'][buff_idx:]
+            self.data[key].extend(value['timestamps'], data)
+            for rollup in self.rollup_data[key]:
+                rollup.extend(value['timestamps'], data)
 
     def onDisconnect(self):
         print("disconnected")
         reactor.stop()
 
-    def get_data(self, field, start, end, min_stride=None):
+    def _window(self, buff, rollups, start, end, channels, extremes):
+        """Data of channels of a block with start <= t <= end, taking each
+        part of the time range from the finest resolution kept for it: the
+        buffer for the last buffer_time, then each rollup in turn.
+
+        Rollups give the mean of each interval, or its minimum and maximum if
+        extremes is True.
+        """
+        now = time.time()
+        # Start of the part of the time range served so far. Rollups kept for
+        # no longer than those before them are skipped.
+        covered = max(start, now - self.buffer_time)
+        parts = [buff.window(covered, end, channels)]
+
+        for rollup, (_, keep_time) in zip(rollups, self.rollups):
+            lower = max(start, now - keep_time)
+            upper = min(covered, end)
+            if lower >= upper:
+                continue
+            t, columns = rollup.window(lower, upper, channels, extremes)
+            n = int(np.searchsorted(t, upper, side='left'))
+            parts.append((t[:n], [column[:n] for column in columns]))
+            covered = lower
+
+        if len(parts) == 1:
+            return parts[0]
+        parts.reverse()
+        return (np.concatenate([t for t, _ in parts]),
+                [np.concatenate(column) for column in zip(*[c for _, c in parts])])
+
+    def _get_data_blocking(self, field, start, end, min_stride=None):
         """Overriding parent method definition.
 
-        Note: min_stride not implemented.
+        Runs in a worker thread, through the parent class's get_data, as
+        reading a buffer on disk can take a while. It only reads the latest
+        snapshot, which the ingest thread never modifies.
+
+        Data older than buffer_time is served from the finest rollup which
+        still covers it. If min_stride is given, data is downsampled with
+        _downsample, keeping the minimum and maximum of each channel.
         """
         start = sisock.base.sisock_to_unix_time(start)
         end = sisock.base.sisock_to_unix_time(end)
 
         _data = {'data': {}, 'timeline': {}}
+        data, rollup_data, blocks = self.snapshot
 
+        # Group the fields by block, as each block has a single timeline.
+        requested = {}
         for field_name in field:
-            try:
-                # Populate _data
-                # _data['data']
-                if field_name not in _data['data']:
-                    _data['data'][field_name] = []
+            # Populate _data
+            # _data['data']
+            _data['data'][field_name] = []
 
-                # Get the data for this field from self.data within given time frame.
-                idx = np.where(np.logical_and(np.array(self.data[field_name]['time']) >= start,
-                                              np.array(self.data[field_name]['time']) <= end))
-                _data['data'][field_name] = np.array(self.data[field_name]['data'])[idx[0]].tolist()
+            if field_name not in blocks:
+                print("Received data query for field {} when it doesn't exist.".format(field_name))
+                continue
 
-                # _data['timeline']
-                _timeline_name = 'observatory.{}'.format(self.target) + '.' + field_name
+            key, channel_name = blocks[field_name]
+            requested.setdefault(key, []).append((field_name, channel_name))
 
-                if _timeline_name not in _data['timeline']:
-                    _data['timeline'][_timeline_name] = {'t': [], 'finalized_until': None}
+        for key, requested_fields in requested.items():
+            fields = [field_name for field_name, _ in requested_fields]
+            channels = [channel_name for _, channel_name in requested_fields]
 
-                _data['timeline'][_timeline_name]['t'] = \
-                    np.array(self.data[field_name]['time'])[idx[0]].tolist()
+            # Get the data for these fields from the snapshot within given
+            # time frame.
+            t, columns = self._window(data[key], rollup_data[key],
+                                      start, end, channels, bool(min_stride))
 
-            except KeyError:
-                print("Received data query for field {} when it doesn't exist.".format(field_name))
+            if min_stride:
+                t, columns = _downsample(t, columns, min_stride)
+
+            # Only copied into lists for serialization.
+            for field_name, column in zip(fields, columns):
+                _data['data'][field_name] = column.tolist()
+
+            # _data['timeline'], shared by all fields in the block
+            _timeline_name = self._timeline_name(key)
+            _data['timeline'][_timeline_name] = {'t': t.tolist(),
+                                                 'finalized_until': None}
 
         return _data
 
@@ -172,22 +963,24 @@ class data_feed_server(sisock.base.DataNodeServer):
         _field = {}
         _timeline = {}
 
-        for channel_name in self.data.keys():
-            # Populate _field and _timeline
-            _timeline_name = 'observatory.{}'.format(self.target) + '.' + channel_name
+        _, _, blocks = self.snapshot
+
+        for field_name, (key, _) in blocks.items():
+            # Populate _field and _timeline, with one timeline per block
+            _timeline_name = self._timeline_name(key)
 
-            if channel_name not in _field:
-                _field[channel_name] = {'description': None,
-                                        'timeline': _timeline_name,
-                                        'type': 'number',
-                                        'units': None}
+            if field_name not in _field:
+                _field[field_name] = {'description': None,
+                                      'timeline': _timeline_name,
+                                      'type': 'number',
+                                      'units': None}
 
             if _timeline_name not in _timeline:
                 _timeline[_timeline_name] = {'interval': None,
                                              'field': []}
 
-            if channel_name not in _timeline[_timeline_name]['field']:
-                _timeline[_timeline_name]['field'].append(channel_name)
+            if field_name not in _timeline[_timeline_name]['field']:
+                _timeline[_timeline_name]['field'].append(field_name)
 
         # Debug printing. Do NOT leave on in production.
         # print("_timeline: {}".format(_timeline))
@@ -212,6 +1005,10 @@ if __name__ == '__main__':
 
     # Optional environment variables.
     buffer_length = int(environ.get('BUFFER_TIME', '3600'))
+    buffer_directory = environ.get('BUFFER_DIRECTORY')
+    # Rollups as "interval:keep_time" pairs, in seconds, i.e. "60:86400".
+    rollups = [tuple(float(x) for x in rollup.split(':'))
+               for rollup in environ.get('ROLLUPS', '').split(',') if rollup.strip()]
 
     # Start our component.
     # When running locally, not in a container.
@@ -223,4 +1020,6 @@ if __name__ == '__main__':
                                 description=environ['DESCRIPTION'],
                                 feed=environ['FEED'],
                                 target=environ['TARGET'],
-                                buffer_time=buffer_length))
+                                buffer_time=buffer_length,
+                                buffer_directory=buffer_directory,
+                                rollups=rollups))
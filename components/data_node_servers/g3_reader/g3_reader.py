@@ -5,44 +5,245 @@ A DataNodeServer which reads housekeeping data from .g3 files written to disk.
 Notes:
     * You will need to also run the sisock component g3-file-scanner, with an
       accompanying MySQL database.
-    * It does not implement a min_stride
+    * It implements min_stride by serving precomputed summaries, if the
+      g3-file-scanner writes them to SUMMARY_DIRECTORY.
     * It does implement a maximum number of data points returned, through the
       MAX_POINTS environment variable (optional).
+    * It serves per field statistics recorded by the g3-file-scanner through
+      an additional get_stats RPC.
 """
 
 import time
 import os
+import glob
+import json
+import queue
+import hashlib
+import threading
+import multiprocessing
 from os import environ
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 import six
-import mysql.connector
 import txaio
 from autobahn.wamp.types import ComponentConfig
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
+from twisted.internet import threads
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet._sslverify import OpenSSLCertificateAuthorities
 from twisted.internet.ssl import CertificateOptions
 from OpenSSL import crypto
 
-from so3g.hk import HKArchiveScanner
+import so3g
+from spt3g.core import G3FrameType
 import sisock
 
 # For logging
 txaio.use_twisted()
 
 
-def _build_file_list(cur, start, end):
-    """Build the file list to read in all the data within a given start/end
-    range.
+def _decode_data_frame(frame, description):
+    """Decode the blocks of an HK data frame into numpy arrays.
 
-    We build the list by querying the database for all files that have fields
-    within the start/end range.
+    Parameters
+    ----------
+    frame : G3Frame
+        HK data frame, with hkagg_type 2
+    description : str
+        description of the provider which wrote the frame
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by sisock field name, i.e. the provider description
+        and the field name joined by a '.'. Each value is a tuple of numpy
+        arrays, (timestamps, data).
+
+    """
+    frame_data = {}
+    for block in frame['blocks']:
+        t = np.array(block.t)
+        for key, value in dict(block.data).items():
+            frame_data[description + '.' + key] = (t, np.array(value))
+
+    return frame_data
+
+
+def _read_g3_frames(filename, frames=None):
+    """Decode housekeeping data frames within a single .g3 file.
+
+    This is run in a worker process, so must remain a module level function
+    and return only picklable objects.
 
     Parameters
     ----------
-    cur : mysql.connector.cursor.MySQLCursor object
-        SQL cursor provided by mysql.connector connection.
+    filename : str
+        full path to the .g3 file to read
+    frames : list
+        list of (byte_offset, description) tuples for the data frames to
+        decode, as recorded by the g3-file-scanner. If None, the whole file is
+        read.
+
+    Returns
+    -------
+    dict
+        Dictionary keyed by the byte offset of each data frame decoded, with
+        the output of _decode_data_frame() as values.
+
+    """
+    reader = so3g.G3IndexedReader(filename)
+    file_data = {}
+
+    # Seek directly to the frames we know we need.
+    if frames is not None:
+        for offset, description in frames:
+            reader.Seek(offset)
+            frame = reader.Process(None)[0]
+            file_data[offset] = _decode_data_frame(frame, description)
+
+        return file_data
+
+    providers = {}
+    while True:
+        offset = reader.Tell()
+        _frames = reader.Process(None)
+        if not _frames:
+            break
+        frame = _frames[0]
+
+        if frame.type != G3FrameType.Housekeeping:
+            continue
+
+        if frame['hkagg_type'] == 1:
+            for provider in frame['providers']:
+                description = str(provider['description']).strip('"')
+                prov_id = int(str(provider['prov_id']))
+                providers[prov_id] = description
+        elif frame['hkagg_type'] == 2:
+            description = providers[int(str(frame['prov_id']))]
+            file_data[offset] = _decode_data_frame(frame, description)
+
+    return file_data
+
+
+def _write_cache_segment(cache_directory, filename, stat, file_data, complete):
+    """Checkpoint frames decoded by _read_g3_frames() to the on-disk cache.
+
+    Each segment is a single .npy file holding every array back to back,
+    which can be memory-mapped, and a .json index giving the location of each
+    array within it. Segments are named for the path, size and mtime of the
+    g3 file they were decoded from, so are invalidated if the file changes.
+
+    Parameters
+    ----------
+    cache_directory : str
+        directory to write the segment to
+    filename : str
+        full path to the g3 file the frames were read from
+    stat : os.stat_result
+        stat of the g3 file, taken before it was read
+    file_data : dict
+        decoded frames, as returned by _read_g3_frames()
+    complete : bool
+        True if file_data holds every frame in the file
+
+    """
+    arrays = []
+    frames = {}
+    position = 0
+    for offset, frame_data in file_data.items():
+        frames[str(offset)] = {}
+        for field_name, (t, y) in frame_data.items():
+            arrays.append(np.asarray(t, dtype=np.float64))
+            arrays.append(np.asarray(y, dtype=np.float64))
+            frames[str(offset)][field_name] = [position, len(t)]
+            position += 2*len(t)
+
+    key = '%s:%d:%r' % (filename, stat.st_size, stat.st_mtime)
+    name = os.path.join(cache_directory, '%s-%d' % (hashlib.sha1(key.encode()).hexdigest(),
+                                                    min(file_data, default=0)))
+
+    index = {'path': filename,
+             'size': stat.st_size,
+             'mtime': stat.st_mtime,
+             'complete': complete,
+             'frames': frames}
+
+    # The index is written last, segments without one are ignored.
+    with open(name + '.npy.tmp', 'wb') as f:
+        np.save(f, np.concatenate(arrays) if arrays else np.zeros(0))
+    os.replace(name + '.npy.tmp', name + '.npy')
+    with open(name + '.json.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(name + '.json.tmp', name + '.json')
+
+
+def _load_cache_segments(cache_directory):
+    """Memory-map the segments of the on-disk cache.
+
+    Segments for g3 files which have since changed or been removed are
+    deleted.
+
+    Parameters
+    ----------
+    cache_directory : str
+        directory segments were written to by _write_cache_segment()
+
+    Returns
+    -------
+    dict
+        Data cache, see G3ReaderServer._scan_data_from_disk(), with arrays
+        which are read-only views into the memory-mapped segments.
+
+    """
+    cache = {}
+
+    for index_file in sorted(glob.glob(os.path.join(cache_directory, '*.json'))):
+        name = index_file[:-len('.json')]
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+            stat = os.stat(index['path'])
+            valid = (stat.st_size == index['size'] and stat.st_mtime == index['mtime'])
+        except (OSError, ValueError, KeyError):
+            valid = False
+
+        if not valid:
+            for stale in (index_file, name + '.npy'):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            continue
+
+        data = np.load(name + '.npy', mmap_mode='r')
+        frames = {}
+        for offset, fields in index['frames'].items():
+            frames[int(offset)] = {field_name: (data[i:i+n], data[i+n:i+2*n])
+                                   for field_name, (i, n) in fields.items()}
+
+        entry = cache.setdefault(index['path'], {'frames': {}, 'complete': False})
+        entry['frames'].update(frames)
+        entry['complete'] = entry['complete'] or index['complete']
+
+    return cache
+
+
+def _frames_to_read(cache, file_list, frame_index, field, start, end):
+    """Determine which frames must be read from disk to answer a query.
+
+    Parameters
+    ----------
+    cache : dict
+        Data cache, see G3ReaderServer._scan_data_from_disk()
+    file_list : list
+        list of files with data in the start/end range
+    frame_index : dict
+        index of data frames, see sisock.index.IndexStore.frame_index()
+    field : list
+        list of sisock field names requested
     start : float
         unixtime stamp for start time
     end : float
@@ -51,37 +252,266 @@ def _build_file_list(cur, start, end):
     Returns
     -------
     list
-        list of complete file paths to read in
+        list of (filename, frames) tuples, suitable as arguments to
+        _read_g3_frames(). frames is None for files which are not indexed.
 
     """
-    # datetime objects from unix times
-    start_dt = datetime.utcfromtimestamp(start)
-    end_dt = datetime.utcfromtimestamp(end)
+    wanted = set(field)
+    to_read = []
 
-    # String formatting for SQL query
-    start_str = start_dt.strftime("%Y-%m-%d %H-%M-%S.%f")
-    end_str = end_dt.strftime("%Y-%m-%d %H-%M-%S.%f")
+    for filename in file_list:
+        entry = cache.get(filename)
+        if entry is not None and entry['complete']:
+            continue
+
+        if filename not in frame_index:
+            to_read.append((filename, None))
+            continue
+
+        cached = entry['frames'] if entry is not None else {}
+        frames = [(offset, description)
+                  for offset, description, _start, _end, _fields in frame_index[filename]
+                  if offset not in cached
+                  and _end >= start and _start <= end
+                  and wanted.intersection(_fields)]
+        if frames:
+            to_read.append((filename, frames))
+
+    return to_read
+
+
+def _merge_file_data(cache, file_list, field, start, end):
+    """Merge per-frame arrays from the cache into a get_data style result.
+
+    Parameters
+    ----------
+    cache : dict
+        Dictionary with file paths as keys, see
+        G3ReaderServer._scan_data_from_disk() for the structure of each value
+    file_list : list
+        list of files to take data from
+    field : list
+        list of sisock field names to return
+    start : float
+        unixtime stamp for start time
+    end : float
+        unixtime stamp for end time
+
+    Returns
+    -------
+    dict, dict
+        data and timeline dictionaries, with a timeline named after each
+        field which has data in the range
+
+    """
+    t_chunks = {field_name: [] for field_name in field}
+    y_chunks = {field_name: [] for field_name in field}
+
+    for filename in file_list:
+        if filename not in cache:
+            continue
+        for frame_data in cache[filename]['frames'].values():
+            for field_name in field:
+                try:
+                    t, y = frame_data[field_name]
+                except KeyError:
+                    continue
+                idx = np.logical_and(t >= start, t <= end)
+                t_chunks[field_name].append(t[idx])
+                y_chunks[field_name].append(y[idx])
+
+    _data = {}
+    _timeline = {}
 
-    print("Querying database for filelist")
-    cur.execute("SELECT path, filename \
-                 FROM feeds \
-                 WHERE id IN (SELECT DISTINCT feed_id \
-                              FROM fields \
-                              WHERE end > %s \
-                              AND start < %s)", (start_str, end_str))
-    path_file_list = cur.fetchall()
+    for field_name in field:
+        if not t_chunks[field_name]:
+            _data[field_name] = np.array([])
+            continue
 
-    # Build file list to read data
-    file_list = []
+        t = np.concatenate(t_chunks[field_name])
+        y = np.concatenate(y_chunks[field_name])
+        order = np.argsort(t, kind='mergesort')
 
-    for path, _file in path_file_list:
-        file_list.append(os.path.join(path, _file))
+        _data[field_name] = y[order]
+        _timeline[field_name] = {'t': t[order],
+                                 'fields': [field_name],
+                                 'finalized_until': None}
 
-    # Remove duplicates
-    file_list = list(set(file_list))
-    file_list.sort()
+    return _data, _timeline
 
-    return file_list
+
+def _summary_level(min_stride):
+    """Select the coarsest summary level no wider than min_stride.
+
+    Parameters
+    ----------
+    min_stride : float or None
+        min_stride passed to get_data
+
+    Returns
+    -------
+    int or None
+        summary bin width in seconds, or None if raw data should be used
+
+    """
+    if min_stride is None:
+        return None
+
+    levels = [level for level in sisock.summary.LEVELS if level <= min_stride]
+    if not levels:
+        return None
+
+    return max(levels)
+
+
+def _summarize_data(summary_directory, file_list, level, field, start, end,
+                    raw_data, raw_timeline):
+    """Build a get_data style result from summary files, at a single summary
+    level.
+
+    Raw data, from files without a summary file, is binned at the same level
+    and merged in. Each bin is returned as two samples, its minimum and its
+    maximum, a quarter of a bin either side of its centre, so that spikes
+    remain visible however far a query is zoomed out.
+
+    Parameters
+    ----------
+    summary_directory : str
+        directory the g3-file-scanner writes summary files to
+    file_list : list
+        list of files with summary files to take data from
+    level : int
+        summary bin width, in seconds
+    field : list
+        list of sisock field names to return
+    start : float
+        unixtime stamp for start time
+    end : float
+        unixtime stamp for end time
+    raw_data, raw_timeline : dict
+        data and timeline dictionaries for files without summaries, as
+        returned by _merge_file_data()
+
+    Returns
+    -------
+    dict, dict
+        data and timeline dictionaries, with a timeline named after each
+        field which has data in the range
+
+    """
+    rollups = {field_name: [] for field_name in field}
+
+    for field_name in field:
+        if field_name in raw_timeline:
+            t = raw_timeline[field_name]['t']
+            y = raw_data[field_name].astype(float)
+            good = ~np.isnan(y)
+            rollups[field_name].append(
+                sisock.summary.combine_rollups(t[good], y[good], y[good], y[good],
+                                               np.ones(np.count_nonzero(good)), level))
+
+    for filename in file_list:
+        path = sisock.summary.summary_path(summary_directory, filename)
+        with np.load(path) as summary:
+            for field_name in field:
+                key = '%d/%s/' % (level, field_name)
+                if key + 't' not in summary.files:
+                    continue
+                rollups[field_name].append(tuple(summary[key + stat]
+                                                 for stat in sisock.summary.STATS))
+
+    _data = {}
+    _timeline = {}
+
+    for field_name in field:
+        if not rollups[field_name]:
+            _data[field_name] = np.array([])
+            continue
+
+        stats = [np.concatenate(s) for s in zip(*rollups[field_name])]
+        order = np.argsort(stats[0], kind='mergesort')
+        t, _min, _max, mean, count = sisock.summary.combine_rollups(
+            *[s[order] for s in stats], width=level)
+
+        t = np.stack((t + level/4., t + 3*level/4.), axis=1).ravel()
+        y = np.stack((_min, _max), axis=1).ravel()
+        idx = np.logical_and(t >= start, t <= end)
+
+        _data[field_name] = y[idx]
+        _timeline[field_name] = {'t': t[idx],
+                                 'fields': [field_name],
+                                 'finalized_until': None}
+
+    return _data, _timeline
+
+
+def _aggregate_stats(rows):
+    """Combine the per file statistics of each field.
+
+    Parameters
+    ----------
+    rows : list
+        statistics of each field in each file, see
+        sisock.index.IndexStore.field_stats()
+
+    Returns
+    -------
+    dict
+        Dictionary with the sisock field name as keys, and a dictionary of
+        samples, nans, min, max, mean and files (the number of files) as
+        values. min, max and mean are None if there were no numeric samples.
+
+    """
+    stats = {}
+    for field, _, _, samples, nans, _min, _max, total in rows:
+        s = stats.setdefault(field, {'samples': 0, 'nans': 0, 'min': None,
+                                     'max': None, 'total': 0., 'files': 0})
+        s['samples'] += samples
+        s['nans'] += nans
+        s['total'] += total
+        s['files'] += 1
+        if _min is not None and (s['min'] is None or _min < s['min']):
+            s['min'] = _min
+        if _max is not None and (s['max'] is None or _max > s['max']):
+            s['max'] = _max
+
+    for s in stats.values():
+        total = s.pop('total')
+        good = s['samples'] - s['nans']
+        s['mean'] = total / good if good and s['min'] is not None else None
+
+    return stats
+
+
+def _estimate_samples(rows, start, end):
+    """Estimate the number of samples of each field within a given start/end
+    range, assuming samples are evenly spread through each file.
+
+    Parameters
+    ----------
+    rows : list
+        statistics of each field in each file, see
+        sisock.index.IndexStore.field_stats()
+    start : float
+        unixtime stamp for start time
+    end : float
+        unixtime stamp for end time
+
+    Returns
+    -------
+    dict
+        Dictionary with the sisock field name as keys, and the estimated
+        number of samples as values.
+
+    """
+    estimate = {}
+    for field, _start, _end, samples, _, _, _, _ in rows:
+        if _end > _start:
+            overlap = (min(end, _end) - max(start, _start)) / (_end - _start)
+            samples *= min(max(overlap, 0.), 1.)
+        estimate[field] = estimate.get(field, 0.) + samples
+
+    return estimate
 
 
 def _format_sisock_time_for_sql(sisock_time):
@@ -115,16 +545,15 @@ def _format_sisock_time_for_sql(sisock_time):
 def _cast_data_timeline_to_list(data, timeline):
     """Cast data and timelines as lists for WAMP serialization.
 
-    The so3g HKArchiveScanner returns data as either native g3 types or numpy
-    arrays. We need them to be lists in order for WAMP to accept them.
+    Data read from disk is held as numpy arrays. We need them to be lists in
+    order for WAMP to accept them.
 
     Parameters
     ----------
     data : dict
-        Data dictionary returned by so3g HKArchiveScanner's get_data() method
+        Data dictionary returned by _merge_file_data()
     timeline : dict
-        Timeline dictionary returned by so3g HKArchiveScanner's get_data()
-        method
+        Timeline dictionary returned by _merge_file_data()
 
     Returns
     -------
@@ -192,151 +621,504 @@ def _down_sample_data(get_data_dict, max_points):
 
 class G3ReaderServer(sisock.base.DataNodeServer):
     """A DataNodeServer serving housekeeping data stored in .g3 format on disk."""
-    def __init__(self, config, sql_config):
+    def __init__(self, config, store):
         ApplicationSession.__init__(self, config)
 
         # Default to 0, which returns all available data
         self.max_points = int(environ.get("MAX_POINTS", 0))
 
+        # Summary files written by the g3-file-scanner, optional
+        self.summary_directory = environ.get("SUMMARY_DIRECTORY")
+
         # Here we set the name of this data node server
         self.name = "g3_reader"
         self.description = "Read g3 files from disk."
 
-        # For SQL connections within blocking methods
-        self.sql_config = sql_config
-
-        # Data cache for opening g3 files
-        self.cache_list = []
-        self.hkas = HKArchiveScanner()
-        self.archive = None
+        # Index of the files on disk, written by the g3-file-scanner
+        self.index = store
+
+        # Cached field lifetimes, and the catalog version they were built
+        # at, updated with the feeds which changed whenever the scanner bumps
+        # the catalog version. Replaced, never mutated, under _fields_lock.
+        self.field_lifetimes = {}
+        self.catalog_version = None
+        self._fields_lock = threading.Lock()
+
+        # Data cache for opening g3 files, keyed by file path. Ingestion is
+        # serialized by _ingest_lock; queries only ever read self.cache, a
+        # snapshot which is replaced, never mutated.
+        self.cache = {}
+        self._ingest_lock = threading.Lock()
+
+        # Optional on-disk checkpoint of the cache, memory-mapped on startup
+        # so a restart doesn't need to re-read the g3 files.
+        self.cache_directory = environ.get("CACHE_DIRECTORY")
+        if self.cache_directory is not None:
+            os.makedirs(self.cache_directory, exist_ok=True)
+            self.cache = _load_cache_segments(self.cache_directory)
+            print("Loaded {} files from the on-disk cache".format(len(self.cache)))
+
+        # Read-ahead of the time windows either side of recent queries. Up to
+        # PREFETCH_BUDGET files are read per window, only while no real
+        # queries are running.
+        self.prefetch_budget = int(environ.get("PREFETCH_BUDGET", 4))
+        self.recent_windows = OrderedDict()
+        self.max_recent_windows = 1024
+        self._active_queries = 0
+        self._query_lock = threading.Lock()
+        self._prefetch_queue = queue.Queue()
+        if self.prefetch_budget > 0:
+            threading.Thread(target=self._prefetch_loop, daemon=True).start()
+
+        # Cold files are decoded in parallel worker processes
+        self.workers = int(environ.get("READER_WORKERS", os.cpu_count() or 1))
+        self._pool_lock = threading.Lock()
+        self.pool = self._new_pool()
 
         # Logging
         self.log = txaio.make_logger()
 
+    def _new_pool(self):
+        """A pool of worker processes to decode g3 files. Workers are started
+        with the start method set in __main__, a forkserver, rather than
+        forked from a reactor thread."""
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def _replace_pool(self, pool):
+        """Replace a broken worker pool with a new one, unless another thread
+        already has."""
+        with self._pool_lock:
+            if self.pool is pool:
+                self.log.error("Worker pool broken, likely by a worker crashing, "
+                               "starting a new one")
+                pool.shutdown(wait=False)
+                self.pool = self._new_pool()
+
+    def _submit(self, filename, frames):
+        """Submit a file to be read by the worker pool, replacing the pool
+        if it's broken.
+
+        Returns
+        -------
+        tuple
+            the pool the file was submitted to, and the Future of its
+            _read_g3_frames() result
+
+        """
+        pool = self.pool
+        try:
+            return pool, pool.submit(_read_g3_frames, filename, frames)
+        except BrokenProcessPool:
+            self._replace_pool(pool)
+            pool = self.pool
+            return pool, pool.submit(_read_g3_frames, filename, frames)
+
+
+    def _scan_data_from_disk(self, file_list, frame_index, field, start, end):
+        """Read data from disk for any frames not yet in the cache. Meant to be
+        called by blockingCallFromThread.
 
-    def _scan_data_from_disk(self, file_list):
-        """Scan data from disk using the so3g HKArchiveScanner. Meant to be called
-        by blockingCallFromThread.
+        Frames missing from the cache are decoded in parallel by the worker
+        pool, one task per file. Only one thread at a time ingests files; once
+        all new frames are read a new cache dictionary is swapped in as
+        self.cache, so concurrent readers holding the previous snapshot are
+        unaffected.
 
         Parameters
         ----------
         file_list : list
-            list of files to scan with the ArchiveScanner
+            list of files to read
+        frame_index : dict
+            index of data frames, see sisock.index.IndexStore.frame_index()
+        field : list
+            list of sisock field names requested
+        start : float
+            unixtime stamp for start time
+        end : float
+            unixtime stamp for end time
 
         Returns
         -------
-        so3g.hk.HKArchive
-            HKArchive object, which has get_fields and get_data methods identical
-            to sisock. Can be used directly to retrieve data.
+        dict
+            Snapshot of the data cache, keyed by file path. Each value is a
+            dictionary with the following entries.
+
+            - frames : the decoded frames, as returned by _read_g3_frames()
+            - complete : True if every frame in the file has been decoded
 
         """
-        for filename in file_list:
-            if filename not in self.cache_list:
+        # Fast path, everything requested is already in the current snapshot.
+        cache = self.cache
+        if not _frames_to_read(cache, file_list, frame_index, field, start, end):
+            return cache
+
+        checkpoint = []
+        with self._ingest_lock:
+            cache = self.cache
+            to_read = _frames_to_read(cache, file_list, frame_index, field,
+                                      start, end)
+            futures = []
+            for filename, frames in to_read:
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    self.log.warn("Could not stat {f}, skipping", f=filename)
+                    continue
+                futures.append((filename, frames, stat) + self._submit(filename, frames))
+
+            new_cache = dict(cache)
+            retried = set()
+            while futures:
+                filename, frames, stat, pool, future = futures.pop(0)
                 try:
-                    self.hkas.process_file(filename)
-                    self.cache_list.append(filename)
+                    file_data = future.result()
+                except BrokenProcessPool:
+                    # A worker died, i.e. so3g crashed on a truncated frame or
+                    # it ran out of memory. Every task in the pool fails, so
+                    # each file is retried once in a new pool.
+                    self._replace_pool(pool)
+                    if filename in retried:
+                        self.log.error("Worker crashed reading file {f}, skipping",
+                                       f=filename)
+                        continue
+                    retried.add(filename)
+                    futures.append((filename, frames, stat) + self._submit(filename, frames))
+                    continue
                 except RuntimeError:
                     self.log.debug("Exception raised while reading file {f}," +
                                    "likely the file is not yet done writing",
                                    f=filename)
-            else:
-                self.log.debug("{f} already in cache list, skipping", f=filename)
-
-        self.archive = self.hkas.finalize()
+                    continue
+                except Exception as e:
+                    self.log.error("Could not read file {f}: {e}", f=filename, e=e)
+                    continue
+
+                entry = new_cache.get(filename, {'frames': {}, 'complete': False})
+                _frames = dict(entry['frames'])
+                _frames.update(file_data)
+                new_cache[filename] = {'frames': _frames,
+                                       'complete': entry['complete'] or frames is None}
+                checkpoint.append((filename, stat, file_data, frames is None))
+
+            self.cache = new_cache
+
+        # Checkpoint outside the lock, the in-memory cache is already updated.
+        if self.cache_directory is not None:
+            for filename, stat, file_data, complete in checkpoint:
+                try:
+                    _write_cache_segment(self.cache_directory, filename, stat,
+                                         file_data, complete)
+                except (OSError, ValueError) as e:
+                    self.log.warn("Could not write {f} to the on-disk cache: {e}",
+                                  f=filename, e=e)
 
-        return self.archive
+        return new_cache
 
 
     def _get_fields_blocking(self, start, end):
         """Over-riding the parent class prototype: see the parent class for the
         API.
 
-        Query the MySQL DB for available fields between the start and end
-        times.
+        Return the fields with data between the start and end times, from a
+        cache of the first and last sample time of each field. Whenever the
+        g3-file-scanner bumps the catalog version, the lifetimes of the feeds
+        which changed since are merged into the cache, which is only rebuilt
+        in full if fields were removed from the index.
 
         """
         # Profiling the get_fields method
         t = time.time()
 
-        # Establish DB connection
-        cnx = mysql.connector.connect(host=self.sql_config['host'],
-                                      user=self.sql_config['user'],
-                                      passwd=self.sql_config['passwd'],
-                                      db=self.sql_config['db'])
-        cur = cnx.cursor()
-        print("SQL server connection established")
-
-        # Get feed_ids and field names from database.
-        print("Querying database for all fields")
-        cur.execute("SELECT description \
-                     FROM description")
-        descriptions = cur.fetchall()
+        start = sisock.base.sisock_to_unix_time(start)
+        end = sisock.base.sisock_to_unix_time(end)
 
-        # print("Queried for fields:", fields) # debug
+        with self._fields_lock:
+            cnx = self.index.connect()
+            cur = cnx.cursor()
+
+            # Lifetimes read after the version may already include later
+            # changes, which merging again next time leaves as they are.
+            version = self.index.catalog_version(cur)
+            cached = self.catalog_version
+
+            if version != cached:
+                if cached is None or self.index.catalog_cleared(cur) > cached:
+                    print("Querying index for field lifetimes")
+                    field_lifetimes = self.index.field_lifetimes(cur)
+                else:
+                    print("Querying index for field lifetimes changed since "
+                          "catalog version {}".format(cached))
+                    field_lifetimes = dict(self.field_lifetimes)
+                    changed = self.index.field_lifetimes(cur, since=cached)
+                    for name, (first, last) in changed.items():
+                        if name in field_lifetimes:
+                            _first, _last = field_lifetimes[name]
+                            first, last = min(first, _first), max(last, _last)
+                        field_lifetimes[name] = (first, last)
+                self.field_lifetimes = field_lifetimes
+                self.catalog_version = version
+
+            # Return DB connection to the pool
+            cur.close()
+            cnx.close()
+
+        field_lifetimes = self.field_lifetimes
 
         # Construct our fields.
         _field = {}
         _timeline = {}
 
-        for description in descriptions:
-            _timeline_name = description[0]
+        for _timeline_name, (first, last) in field_lifetimes.items():
+            if first > end or last < start:
+                continue
+
+            _field[_timeline_name] = {'description': None,
+                                      'timeline': _timeline_name,
+                                      'type': 'number',
+                                      'units': None}
+
+            _timeline[_timeline_name] = {'interval': None,
+                                         'field': [_timeline_name]}
+
+        total_time = time.time() - t
+        print("Time to build field list:", total_time)
+
+        return _field, _timeline
+
+    @inlineCallbacks
+    def after_onJoin(self, details):
+        """Register get_stats, alongside the procedures of the parent
+        class."""
+        procedure = sisock.base.uri("consumer." + self.name + ".get_stats")
+        try:
+            yield self.register(self.get_stats, procedure)
+            self.log.info("Registered procedure %s." % procedure)
+        except Exception as e:
+            self.log.error("Could not register procedure: %s." % (e))
+
+    @inlineCallbacks
+    def get_stats(self, field, start, end):
+        """Get statistics of fields, from the index, without opening any g3
+        files.
+
+        Statistics are recorded per file, so cover the whole of every file
+        with data between start and end.
+
+        Parameters
+        ----------
+        field : list of strings
+            The list of fields you want statistics of.
+        start : float
+            The start time: if positive, interpret as a UNIX time; if 0 or
+            negative, begin `start` seconds ago.
+        end : float
+            The end time, using the same format as `start`.
+
+        Returns
+        -------
+        dictionary
+            Dictionary with the field names as keys, and a dictionary with
+            the following entries as values.
+
+            - samples : number of samples
+            - nans : number of NaN samples
+            - min, max, mean : of the samples which are not NaN, or
+              :obj:`None` if there are none
+            - files : number of files the samples are in
 
-            if _timeline_name not in _field:
-                _field[_timeline_name] = {'description': None,
-                                          'timeline': _timeline_name,
-                                          'type': 'number',
-                                          'units': None}
+            Fields without any data are left out.
 
-            if _timeline_name not in _timeline:
-                _timeline[_timeline_name] = {'interval': None,
-                                             'field': []}
+        """
+        data = yield threads.deferToThread(self._get_stats_blocking, field,
+                                           start, end)
+        returnValue(data)
 
-            if _timeline_name not in _timeline[_timeline_name]['field']:
-                _timeline[_timeline_name]['field'].append(_timeline_name)
+    def _get_stats_blocking(self, field, start, end):
+        """Blocking part of get_stats, see get_stats for the API."""
+        start = sisock.base.sisock_to_unix_time(start)
+        end = sisock.base.sisock_to_unix_time(end)
 
-        # Close DB connection
+        cnx = self.index.connect()
+        cur = cnx.cursor()
+        rows = self.index.field_stats(cur, field, start, end)
         cur.close()
         cnx.close()
 
-        total_time = time.time() - t
-        print("Time to build field list:", total_time)
+        return _aggregate_stats(rows)
 
-        return _field, _timeline
+    def _schedule_prefetch(self, field, start, end):
+        """Queue read-ahead of the windows adjacent to a query.
+
+        The last query window of each field is tracked to guess which way the
+        user is panning. Both adjacent windows are read ahead after a zoom or
+        the first query for a field. Only the windows of the
+        max_recent_windows fields queried most recently are kept. The window
+        after a query is only read ahead once it has passed, so live queries
+        don't read ahead into the future.
+
+        Parameters
+        ----------
+        field : list
+            list of sisock field names queried
+        start : float
+            unixtime stamp for start time of the query
+        end : float
+            unixtime stamp for end time of the query
+
+        """
+        with self._query_lock:
+            previous = self.recent_windows.get(field[0]) if field else None
+
+            for field_name in field:
+                self.recent_windows[field_name] = (start, end)
+                self.recent_windows.move_to_end(field_name)
+            while len(self.recent_windows) > self.max_recent_windows:
+                self.recent_windows.popitem(last=False)
+
+        width = end - start
+        if previous is None or start <= previous[0]:
+            self._prefetch_queue.put((list(field), start - width, start, True))
+        if (previous is None or start >= previous[0]) and end + width <= time.time():
+            self._prefetch_queue.put((list(field), end, end + width, False))
+
+    def _prefetch_loop(self):
+        """Read ahead queued windows in the background, for the lifetime of the
+        server. Runs in its own thread."""
+        while True:
+            field, start, end, backwards = self._prefetch_queue.get()
+
+            # Yield to real queries.
+            while self._active_queries:
+                time.sleep(0.1)
+
+            try:
+                self._prefetch(field, start, end, backwards)
+            except Exception as e:
+                self.log.warn("Read-ahead of {start} to {end} failed: {e}",
+                              start=start, end=end, e=e)
+
+    def _prefetch(self, field, start, end, backwards):
+        """Read ahead the frames needed for a query, one file at a time,
+        nearest the current window first.
+
+        Stops once PREFETCH_BUDGET files have been read, or as soon as a real
+        query arrives.
+
+        Parameters
+        ----------
+        field : list
+            list of sisock field names to read ahead
+        start : float
+            unixtime stamp for start time
+        end : float
+            unixtime stamp for end time
+        backwards : bool
+            True if the window precedes the current one, so the latest files
+            are nearest
+
+        """
+        cnx = self.index.connect()
+        cur = cnx.cursor()
+        file_list = self.index.file_list(cur, start, end, fields=field)
+        frame_index = self.index.frame_index(cur, start, end, fields=field)
+        cur.close()
+        cnx.close()
+
+        to_read = [filename for filename, _ in
+                   _frames_to_read(self.cache, file_list, frame_index, field, start, end)]
+        if backwards:
+            to_read.reverse()
+
+        for filename in to_read[:self.prefetch_budget]:
+            if self._active_queries:
+                self.log.debug("Read-ahead cancelled by incoming query")
+                return
+            self.log.debug("Reading ahead {f}", f=filename)
+            self._scan_data_from_disk([filename], frame_index, field, start, end)
 
     def _get_data_blocking(self, field, start, end, min_stride=None):
         """Over-riding the parent class prototype: see the parent class for the
         API.
 
+        Real queries take priority over read-ahead, which is cancelled while
+        any are running.
+
         """
+        # Drop stale read-ahead requests, this query supersedes them.
+        while True:
+            try:
+                self._prefetch_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        with self._query_lock:
+            self._active_queries += 1
+        try:
+            return self._read_data(field, start, end, min_stride)
+        finally:
+            with self._query_lock:
+                self._active_queries -= 1
+
+    def _read_data(self, field, start, end, min_stride=None):
+        """Read data for get_data, see the parent class for the API."""
         # Benchmarking
         t_data = time.time()
 
-        # Establish DB connection
-        cnx = mysql.connector.connect(host=self.sql_config['host'],
-                                      user=self.sql_config['user'],
-                                      passwd=self.sql_config['passwd'],
-                                      db=self.sql_config['db'])
+        # Get a DB connection from the pool
+        cnx = self.index.connect()
         cur = cnx.cursor()
-        self.log.debug("SQL server connection established")
 
         # Format start and end times
         start = sisock.base.sisock_to_unix_time(start)
         end = sisock.base.sisock_to_unix_time(end)
 
         # Build the list of files to open
-        file_list = _build_file_list(cur, start, end)
+        file_list = self.index.file_list(cur, start, end, fields=field)
         self.log.debug("Built file list: {}".format(file_list))
-
-        # Close DB connection
+        frame_index = self.index.frame_index(cur, start, end, fields=field)
+
+        # If more than MAX_POINTS samples would be returned anyway, serve
+        # from the summaries at the stride that would be downsampled to.
+        if self.summary_directory is not None and self.max_points:
+            stride = (end - start) / self.max_points
+            if min_stride is None or min_stride < stride:
+                estimate = _estimate_samples(
+                    self.index.field_stats(cur, field, start, end), start, end)
+                if estimate and max(estimate.values()) > self.max_points:
+                    self.log.debug("Estimated {n} samples, using a stride of {stride}s",
+                                   n=max(estimate.values()), stride=stride)
+                    min_stride = stride
+
+        # Return DB connection to the pool
         cur.close()
         cnx.close()
 
-        # Use HKArchiveScanner to read data from disk
+        # Use summary files where the requested stride allows it
+        level = None
+        if self.summary_directory is not None:
+            level = _summary_level(min_stride)
+
+        summary_list = []
+        if level is not None:
+            summary_list = [f for f in file_list
+                            if os.path.exists(sisock.summary.summary_path(self.summary_directory, f))]
+            file_list = sorted(set(file_list) - set(summary_list))
+            self.log.debug("Using {level}s summaries for {n} files",
+                           level=level, n=len(summary_list))
+
+        # Read any uncached frames from disk
         self.log.debug('Reading data from disk from {start} to {end}'.format(start=start, end=end))
-        self._scan_data_from_disk(file_list)
+        cache = self._scan_data_from_disk(file_list, frame_index, field, start, end)
 
         self.log.info(f"Getting data for fields: {field}")
-        _data, _timeline = self.archive.get_data(field, start, end, min_stride, short_match=True)
+        _data, _timeline = _merge_file_data(cache, file_list, field, start, end)
+
+        if level is not None:
+            _data, _timeline = _summarize_data(self.summary_directory,
+                                               summary_list, level, field,
+                                               start, end, _data, _timeline)
+        elif self.prefetch_budget > 0:
+            self._schedule_prefetch(field, start, end)
 
         # Cast as lists
         _new_data, _new_timeline = _cast_data_timeline_to_list(_data, _timeline)
@@ -355,6 +1137,10 @@ class G3ReaderServer(sisock.base.DataNodeServer):
 
 
 if __name__ == "__main__":
+    # Start g3 file workers from a forkserver, rather than forking them from
+    # a reactor thread.
+    multiprocessing.set_start_method('forkserver')
+
     # Give time for crossbar server to start
     time.sleep(5)
 
@@ -369,26 +1155,13 @@ if __name__ == "__main__":
 
     opt = CertificateOptions(trustRoot=OpenSSLCertificateAuthorities([cert]))
 
-    # Check variables setup when creating the Docker container.
-    required_env = ['SQL_HOST', 'SQL_USER', 'SQL_PASSWD', 'SQL_DB']
-
-    for var in required_env:
-        try:
-            environ[var]
-        except KeyError:
-            print("Required environment variable {} is missing. \
-                   Check your environment setup and try again.".format(var))
-
-    # SQL Config
-    # User/password just for development purposes, obviously change in production.
-    SQL_CONFIG = {'host': environ['SQL_HOST'],
-                  'user': environ['SQL_USER'],
-                  'passwd': environ['SQL_PASSWD'],
-                  'db': environ['SQL_DB']}
+    # The index is stored in MySQL, configured by the SQL_* environment
+    # variables, unless INDEX_BACKEND is "sqlite".
+    INDEX = sisock.index.from_environ(environ, pool_size=16)
 
     # Start our component.
     runner = ApplicationRunner("wss://%s:%d/ws" % (sisock.base.SISOCK_HOST,
                                                    sisock.base.SISOCK_PORT),
                                sisock.base.REALM, ssl=opt)
     runner.run(G3ReaderServer(ComponentConfig(sisock.base.REALM, {}),
-                              sql_config=SQL_CONFIG))
+                              store=INDEX))
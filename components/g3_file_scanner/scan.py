@@ -1,14 +1,15 @@
 import time
 import os
+import multiprocessing
 from os import environ
-from datetime import datetime
 
-import mysql.connector
+import numpy as np
 
 import so3g
-from spt3g import core
 from spt3g.core import G3FrameType
 
+import sisock
+
 def _extract_feeds_from_status_frame(frame):
     """Get the prov_id and description from each provider in an HKStatus frame.
 
@@ -28,335 +29,555 @@ def _extract_feeds_from_status_frame(frame):
     return feeds
 
 # G3 Modules
-def add_files_to_feeds_table(frame, cur, r, f):
+def collect_feeds(frame, feeds):
     """Parse the frames, gathering feed information.
 
     Parameters
     ----------
     frame : G3Frame
-        The G3Frame which the G3Pipeline will pass to us.
-    cur : mysql.connector.cursor.MySQLCursor object
-        SQL cursor provided by mysql.connector connection.
-    r : string
-        The pathname of the file, gathered from an os.walk call.
-    f : string
-        The basename of the g3 file to parse.
+        The G3Frame to parse, as read from the g3 file.
+    feeds : set
+        Set of (prov_id, description) tuples for the file, which each
+        provider in an HKStatus frame is added to.
     """
-    feeds = []
     # Build feeds list for g3 file
     if frame.type == G3FrameType.Housekeeping:
         if frame['hkagg_type'] == 1:
-            feeds = _extract_feeds_from_status_frame(frame)
-    else:
+            feeds.update(_extract_feeds_from_status_frame(frame))
+
+def _field_stats(data):
+    """Sample count, NaN count, min, max and sum of the samples of a field.
+
+    min and max are None if there are no numeric samples which aren't NaN.
+
+    """
+    y = np.asarray(data)
+    if y.dtype.kind not in 'biuf':
+        return (len(y), 0, None, None, 0.)
+
+    y = y.astype(float)
+    good = y[~np.isnan(y)]
+    if len(good) == 0:
+        return (len(y), len(y), None, None, 0.)
+
+    return (len(y), len(y) - len(good), float(good.min()), float(good.max()),
+            float(good.sum()))
+
+def _merge_stats(a, b):
+    """Combine two (start, end, samples, nans, min, max, sum) lists, as kept
+    by collect_fields_and_stats."""
+    def pick(f, x, y):
+        """f(x, y), ignoring either if None."""
+        return y if x is None else x if y is None else f(x, y)
+
+    return [min(a[0], b[0]), max(a[1], b[1]), a[2] + b[2], a[3] + b[3],
+            pick(min, a[4], b[4]), pick(max, a[5], b[5]), a[6] + b[6]]
+
+def _block_spans(frame):
+    """Get the time span, and statistics of each field, of each block in an
+    HKData frame.
+
+    Parameters
+    ----------
+    frame : G3Frame
+        The G3Frame to parse, as read from the g3 file.
+
+    Returns
+    -------
+    list
+        list of (start, end, stats) tuples, one per non-empty block, with
+        start/end as unix timestamps, and stats a dict from field name to
+        (samples, nans, min, max, sum), see _field_stats. Empty if not an
+        HKData frame.
+
+    """
+    spans = []
+    if frame.type == G3FrameType.Housekeeping and frame['hkagg_type'] == 2:
+        for block in frame['blocks']:
+            t = np.asarray(block.t)
+            if len(t) == 0:
+                continue
+            stats = {field: _field_stats(data)
+                     for field, data in dict(block.data).items()}
+            spans.append((float(t.min()), float(t.max()), stats))
+
+    return spans
+
+def collect_fields_and_stats(frame, spans, field_stats):
+    """Parse the frames, gathering field information such as start/end times
+    and sample statistics.
+
+    Parameters
+    ----------
+    frame : G3Frame
+        The G3Frame to parse, as read from the g3 file.
+    spans : list
+        Block time spans and statistics for the frame, from _block_spans.
+    field_stats : dict
+        Map from (prov_id, field) to a [start, end, samples, nans, min, max,
+        sum] list, with start/end as unix timestamps, spanning the data seen
+        so far in the file.
+    """
+    if not spans:
         return
 
-    # Each file can (and probably will) contain more than one feed
-    for (prov_id, description) in feeds:
-        # Get ID from the file/feed if it exists.
-        cur.execute("SELECT id FROM feeds WHERE filename=%s AND prov_id=%s", (f, prov_id))
-        _r = cur.fetchall()
-
-        if not _r:
-            result = None
-        else:
-            result = _r[0]
-
-        if result is not None:
-            feed_id = result[0]
-        else:
-            feed_id = None
-
-        # If the ID doesn't exist, the file/feed isn't in the table yet.
-        if feed_id is None:
-            # Add file/feed to table.
-            cur.execute("INSERT IGNORE \
-                         INTO feeds \
-                             (filename, path, prov_id, description) \
-                         VALUES \
-                             (%s, %s, %s, %s)", (f, r, prov_id, description))
-
-def add_fields_and_times_to_db(frame, cur, r, f):
-    """Parse the frames, gathering field information such as start/end times.
+    prov_id = int(str(frame['prov_id']))
+
+    # Combine the statistics of each field within this frame.
+    for start, end, stats in spans:
+        for field, _stats in stats.items():
+            new = [start, end] + list(_stats)
+            old = field_stats.get((prov_id, field))
+            field_stats[(prov_id, field)] = new if old is None else _merge_stats(old, new)
+
+def collect_frames(frame, spans, offset, frames):
+    """Parse the frames, gathering the location, time span and fields of each
+    HK data frame, so that the g3-reader can seek directly to the frames it
+    needs.
 
     Parameters
     ----------
     frame : G3Frame
-        The G3Frame which the G3Pipeline will pass to us.
-    cur : mysql.connector.cursor.MySQLCursor object
-        SQL cursor provided by mysql.connector connection.
-    r : string
-        The pathname of the file, gathered from an os.walk call.
-    f : string
-        The basename of the g3 file to parse.
+        The G3Frame to parse, as read from the g3 file.
+    spans : list
+        Block time spans and statistics for the frame, from _block_spans.
+    offset : int
+        The byte offset of the frame within the file.
+    frames : list
+        List of (prov_id, offset, start, end, fields) tuples, one per data
+        frame, with start/end as unix timestamps.
     """
-    if frame.type == G3FrameType.Housekeeping:
-        if frame['hkagg_type'] == 2:
-            prov_id = frame['prov_id']
-        else:
-            return
-    else:
+    if not spans:
         return
 
-    # Get ID from the filed/prov_id if it exists.
-    cur.execute("SELECT id, scanned FROM feeds WHERE filename=%s AND prov_id=%s", (f, prov_id))
-    _r = cur.fetchall()
+    prov_id = int(str(frame['prov_id']))
+    start = min(span[0] for span in spans)
+    end = max(span[1] for span in spans)
+    fields = set()
+    for span in spans:
+        fields.update(span[2])
 
-    # _r will be [] if empty.
-    if not _r:
-        result = None
-    else:
-        result = _r[0]
+    frames.append((prov_id, offset, start, end, sorted(fields)))
 
-    if result is not None:
-        feed_id = result[0]
-        scanned = bool(result[1]) # True if already scanned by this script.
-    else:
-        raise Exception("%s is not in feed database, something went wrong."%(f))
+def add_samples_to_summary(frame, providers, samples):
+    """Parse the frames, collecting data samples to build summaries from.
 
-    if not scanned:
-        # Get start and end times for each field within this frame.
-        print("Adding %s/%s to G3Reader"%(r, f))
-        start_times = {}
-        end_times = {}
+    Parameters
+    ----------
+    frame : G3Frame
+        The G3Frame to parse, as read from the g3 file.
+    providers : dict
+        Map from prov_id to description, filled from HKStatus frames.
+    samples : dict
+        Map from sisock field name to a list of (timestamps, data) array
+        tuples, filled from HKData frames.
+    """
+    if frame.type != G3FrameType.Housekeeping:
+        return
+
+    if frame['hkagg_type'] == 1:
+        for prov_id, description in _extract_feeds_from_status_frame(frame):
+            providers[prov_id] = description
+    elif frame['hkagg_type'] == 2:
+        description = providers[int(str(frame['prov_id']))]
         for block in frame['blocks']:
-            for field in dict(block.data).keys():
-                times = list(block.t)
-                if field not in start_times:
-                    start_times[field] = datetime.fromtimestamp(times[0])
-                    end_times[field] = datetime.fromtimestamp(times[len(times)-1])
-                else:
-                    if datetime.fromtimestamp(times[0]) < start_times[field]:
-                        start_times[field] = datetime.fromtimestamp(times[0])
-                    if datetime.fromtimestamp(times[len(times)-1]) > end_times[field]:
-                        end_times[field] = datetime.fromtimestamp(times[len(times)-1])
-
-            # Check for feed/field combo in DB, also compare start/end times before updating.
-            for field in dict(block.data).keys():
-                # Format for DB entry.
-                _start = start_times[field].strftime("%Y-%m-%d %H-%M-%S.%f")
-                _end = end_times[field].strftime("%Y-%m-%d %H-%M-%S.%f")
-
-                # Query for existing start/end times.
-                cur.execute("SELECT feed_id, field, start, end \
-                             FROM fields \
-                             WHERE feed_id=%s \
-                             AND field=%s", (feed_id, field))
-                _r = cur.fetchall()
-                if not _r:
-                    result = None
-                else:
-                    result = _r[0]
-
-                if result is None:
-                    # INSERT
-                    print("Inserting start={} and end={} to feed_id {} for field {}".format(_start,
-                                                                                            _end,
-                                                                                            feed_id,
-                                                                                            field))
-                    cur.execute("INSERT \
-                                 INTO fields \
-                                     (feed_id, field, start, end) \
-                                 VALUES (%s, %s, %s, %s)", (feed_id, field, _start, _end))
-                else:
-                    # UPDATE (only if start < db_start or end > db_end)
-                    _id, _field, db_start, db_end = result
-                    print("Updating start={} and end={} for feed_id {}, field {}".format(_start,
-                                                                                         _end,
-                                                                                         feed_id,
-                                                                                         field))
-                    if start_times[field] < db_start:
-                        cur.execute("UPDATE fields \
-                                     SET start=%s \
-                                     WHERE feed_id=%s \
-                                     AND field=%s", (_start, feed_id, field))
-                    if end_times[field] > db_end:
-                        cur.execute("UPDATE fields \
-                                     SET end=%s \
-                                     WHERE feed_id=%s \
-                                     AND field=%s", (_end, feed_id, field))
-    else:
-        # debug print
-        #print("%s/%s containing feed %s has already been scanned, skipping."%(r, f, feed))
-        pass
+            t = np.array(block.t)
+            for field, data in dict(block.data).items():
+                samples.setdefault(description + '.' + field, []).append((t, np.array(data)))
 
 # Non-G3 Modules
-def init_tables(config):
-    """Initialize the tables if they don't exist.
+def summary_offset(path):
+    """Byte offset in the g3 file just past the last frame included in a
+    summary file, or None if there is no summary file, or it predates the
+    offset being recorded."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        if 'offset' not in f.files:
+            return None
+        return int(f['offset'])
+
+def write_summary(samples, path, offset):
+    """Write min/max/mean/count rollups of each field at each of the
+    sisock.summary.LEVELS to a compressed numpy .npz file.
+
+    Arrays are stored under the key "<level>/<field>/<stat>", where stat is
+    one of t (bin start time), min, max, mean or count. If the file already
+    exists, the new samples are merged into it. The offset is stored under
+    the key "offset", so that frames already summarized are never merged in
+    again, even if the scanner stopped before recording in the index that it
+    had read them.
 
     Parameters
     ----------
-    config : dict
-        SQL config for the DB connection
+    samples : dict
+        samples collected by add_samples_to_summary
+    path : str
+        path to write the summary file to
+    offset : int
+        byte offset in the g3 file just past the last frame summarized
 
     """
-    # Establish DB connection.
-    cnx = mysql.connector.connect(host=config['host'],
-                                  user=config['user'],
-                                  passwd=config['passwd'],
-                                  db=config['db'])
-    cur = cnx.cursor()
-    print("SQL server connection established")
+    arrays = {}
+    if os.path.exists(path):
+        with np.load(path) as f:
+            arrays = {key: f[key] for key in f.files}
+
+    for field, chunks in samples.items():
+        t = np.concatenate([c[0] for c in chunks])
+        y = np.concatenate([c[1] for c in chunks]).astype(float)
+        good = ~np.isnan(y)
+        order = np.argsort(t[good], kind='mergesort')
+        t = t[good][order]
+        y = y[good][order]
+
+        # Each level is built from the one before it.
+        rollup = (t, y, y, y, np.ones(len(t)))
+        for level in sisock.summary.LEVELS:
+            rollup = sisock.summary.combine_rollups(*rollup, width=level)
+            keys = ['%d/%s/%s' % (level, field, stat)
+                    for stat in sisock.summary.STATS]
+
+            if keys[0] in arrays:
+                # Merge with the existing bins, which may share the first
+                # new bin.
+                merged = [np.concatenate((arrays[key], array))
+                          for key, array in zip(keys, rollup)]
+                order = np.argsort(merged[0], kind='mergesort')
+                merged = sisock.summary.combine_rollups(*[m[order] for m in merged],
+                                                        width=level)
+            else:
+                merged = rollup
+
+            arrays.update(zip(keys, merged))
+
+    arrays['offset'] = np.array(offset)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+def scan_file(root, g3, summary=None, offset=0, providers=None):
+    """Read a g3 file, gathering everything needed to index it.
+
+    This does not touch the DB, so that it can be run in a worker process,
+    and returns only picklable objects.
 
-    # Check what tables exist, create the tables we need if they don't exist.
-    table_query = cur.execute("SHOW tables;")
-
-    tables = []
-    for row in cur.fetchall():
-        tables.append(row[0])
-
-    print(tables)
-
-    if "feeds" not in tables and "fields" not in tables:
-        print("Initializing feeds and fields tables.")
-        cur.execute("CREATE TABLE feeds \
-                         (id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, \
-                          filename varchar(255), \
-                          path varchar(255), \
-                          prov_id INT, \
-                          description varchar(255), \
-                          scanned BOOL NOT NULL DEFAULT 0)")
-        cur.execute("CREATE UNIQUE INDEX feed_index ON feeds (`filename`, `prov_id`)")
-        cur.execute("CREATE TABLE fields \
-                         (feed_id INT NOT NULL, \
-                          field varchar(255), \
-                          start DATETIME(6), \
-                          end DATETIME(6))")
-        cur.execute("CREATE UNIQUE INDEX index_field ON fields (`feed_id`, `field`)")
-
-    if "description" not in tables:
-        cur.execute("CREATE TABLE description \
-                         (description varchar(255) NOT NULL PRIMARY KEY)")
+    Parameters
+    ----------
+    root : str
+        The pathname of the file, gathered from an os.walk call.
+    g3 : str
+        The basename of the g3 file to read.
+    summary : str
+        Path to write the summary file to, see write_summary. If None, no
+        summary is written.
+    offset : int
+        Byte offset to start reading from, to resume reading a file which was
+        still being written.
+    providers : dict
+        Map from prov_id to description for the HKStatus frames before
+        offset, needed to summarize the data after it.
 
-    cnx.commit()
-    cur.close()
-    cnx.close()
+    Returns
+    -------
+    dict
+        Dictionary with the feeds, field_stats and frames gathered from the
+        file, see sisock.index.IndexStore.write_file, 'offset', the byte
+        offset just past the last frame read, and 'complete', which is False
+        if the file could not be read to the end.
 
-def scan_directory(directory, config):
+    """
+    providers = dict(providers or {})
+    samples = {}
+
+    # Frames before this are already in the summary.
+    summarized = 0
+    if summary is not None:
+        summarized = summary_offset(summary) or 0
+    feeds = set()
+    field_stats = {}
+    data_frames = []
+
+    try:
+        # Read frame by frame, rather than with a G3Pipeline, so we know the
+        # byte offset of each frame.
+        reader = so3g.G3IndexedReader(os.path.join(root, g3))
+        if offset:
+            reader.Seek(offset)
+        while True:
+            frame_offset = reader.Tell()
+            frames = reader.Process(None)
+            if not frames:
+                break
+            for frame in frames:
+                spans = _block_spans(frame)
+                collect_feeds(frame, feeds)
+                collect_fields_and_stats(frame, spans, field_stats)
+                collect_frames(frame, spans, frame_offset, data_frames)
+                if summary is not None:
+                    # Still read the providers from frames already
+                    # summarized, discarding their samples.
+                    add_samples_to_summary(frame, providers,
+                                           samples if frame_offset >= summarized else {})
+            # Only move past frames which were fully decoded.
+            offset = reader.Tell()
+        complete = True
+    except RuntimeError:
+        print("Could not read {} past byte {}, ".format(os.path.join(root, g3), offset) +
+              "file likely still being written.")
+        complete = False
+
+    # Summarize the complete frames, even if the file is still being
+    # written, the rest are added when reading resumes.
+    if summary is not None and samples:
+        write_summary(samples, summary, offset)
+
+    return {'feeds': feeds,
+            'field_stats': field_stats,
+            'frames': data_frames,
+            'offset': offset,
+            'complete': complete}
+
+def _scan_file_task(task):
+    """Unpack a task for Pool.imap_unordered, returning it alongside the
+    result of scan_file."""
+    root, g3, state, summary, offset, providers = task
+    return task, scan_file(root, g3, summary, offset, providers)
+
+def scan_directory(directory, store, summary_directory=None, workers=1,
+                   batch_size=20, files=None):
     """Scan a given directory for .g3 files, adding them to the Database.
 
+    With more than one worker, files are read in parallel worker processes,
+    while this process alone writes to the DB.
+
     Parameters
     ----------
     directory : str
         the top level directory to scan
-    config : dict
-        SQL config for the DB connection
+    store : sisock.index.IndexStore
+        index to record the files in
+    summary_directory : str
+        directory to write summary files to, see write_summary. If None, no
+        summaries are written.
+    workers : int
+        number of worker processes to read files with
+    batch_size : int
+        number of files to write to the DB per transaction
+    files : list
+        list of (root, filename) tuples to consider, rather than walking the
+        whole directory
 
     """
     # Establish DB connection.
-    cnx = mysql.connector.connect(host=config['host'],
-                                  user=config['user'],
-                                  passwd=config['passwd'],
-                                  db=config['db'])
+    cnx = store.connect()
     cur = cnx.cursor()
     print("SQL server connection established")
 
+    # Size and mtime of every file as it was when last scanned, and where
+    # reading got up to.
+    file_states = store.file_states(cur)
 
     # Gather all files we want to scan.
-    a = os.walk(directory)
-
-    # Iterate over file list and run pipeline on each file.
-    for root, directory, _file in a:
-        for g3 in _file:
-            if g3[-2:] == "g3":
-                try:
-                    p = core.G3Pipeline()
-                    #print("Adding %s/%s to G3Reader"%(root, g3))
-                    p.Add(core.G3Reader, filename=os.path.join(root, g3))
-                    p.Add(add_files_to_feeds_table, cur=cur, r=root, f=g3)
-                    p.Add(add_fields_and_times_to_db, cur=cur, r=root, f=g3)
-                    p.Run()
-                    # Mark feed_id as 'scanned' in feeds table.
-                    cur.execute("UPDATE feeds \
-                                 SET scanned=1 \
-                                 WHERE filename=%s \
-                                 AND path=%s", (g3, root))
-                    cnx.commit()
-                except RuntimeError:
-                    print("Could not read {}, ".format(os.path.join(root, g3)) +
-                          "file likely still being written.")
-
-    cur.close()
-    cnx.close()
-
-
-def build_description_table(config):
-    """Build the list of field names that the sisock g3-reader data server will
-    return. This is stored in the description table.
+    if files is None:
+        files = ((root, g3) for root, _, _file in os.walk(directory) for g3 in _file)
+    tasks = []
+
+    for root, g3 in files:
+        if g3[-2:] == "g3":
+            # Skip files which haven't changed since they were scanned,
+            # without opening them.
+            try:
+                stat = os.stat(os.path.join(root, g3))
+            except OSError:
+                continue
+            state = (stat.st_size, stat.st_mtime)
+            previous = file_states.get((root, g3))
+            if previous is not None and previous[:2] == state:
+                continue
+
+            summary = None
+            if summary_directory is not None:
+                summary = sisock.summary.summary_path(summary_directory, os.path.join(root, g3))
+
+            # g3 files are only appended to, so resume reading a file which
+            # has grown after the last frame read from it. A file which
+            # shrank has been replaced, and is indexed again from the start,
+            # as is one whose summary can't be resumed.
+            offset = 0
+            if previous is not None:
+                size, mtime, offset = previous
+                if stat.st_size < max(size, offset):
+                    offset = 0
+                if summary is not None and not os.path.exists(summary):
+                    offset = 0
+
+                if offset:
+                    print("%s/%s grew since last scan, resuming at byte %d" % (root, g3, offset))
+                    store.mark_unscanned(cur, root, g3)
+                else:
+                    print("%s/%s changed since last scan, rescanning" % (root, g3))
+                    store.clear_file(cur, root, g3)
 
-    Parameters
-    ----------
-    config : dict
-        SQL config for the DB connection
+            providers = {}
+            if offset and summary is not None:
+                providers = store.providers(cur, root, g3)
+            elif summary is not None and os.path.exists(summary):
+                # Stale, or from before the file was last indexed.
+                os.remove(summary)
 
-    """
-    print("Buliding description table")
-    # Profiling building the field list
-    t = time.time()
+            tasks.append((root, g3, state, summary, offset, providers))
 
-    # Establish DB connection.
-    cnx = mysql.connector.connect(host=config['host'],
-                                  user=config['user'],
-                                  passwd=config['passwd'],
-                                  db=config['db'])
-    cur = cnx.cursor()
-    print("SQL server connection established")
+    cnx.commit()
+    print("Found {} new or changed files to scan".format(len(tasks)))
 
-    # Get feed_ids and field names from database.
-    print("Querying database for all fields")
-    cur.execute("SELECT DISTINCT F.field, E.description \
-                 FROM fields F, feeds E \
-                 WHERE F.feed_id=E.id")
-    fields = cur.fetchall()
+    pool = None
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_scan_file_task, tasks)
+    else:
+        results = map(_scan_file_task, tasks)
+
+    t_start = time.time()
+    t_report = t_start
+    changed = 0
+
+    # A worker raising anything leaves the pool running, so it's terminated,
+    # and the DB connection closed, however the loop exits.
+    try:
+        # Iterate over the results, writing them to the DB as they arrive.
+        for i, (task, result) in enumerate(results, 1):
+            root, g3, state = task[:3]
+            changed += store.write_file(cur, root, g3, result['feeds'],
+                                        result['field_stats'], result['frames'])
+
+            if result['complete']:
+                # Mark feed_id as 'scanned' in feeds table.
+                store.mark_scanned(cur, root, g3)
+
+            # Record the state of the file we scanned, and where to resume.
+            store.update_file_state(cur, root, g3, state[0], state[1], result['offset'])
+
+            if i % batch_size == 0 or i == len(tasks):
+                # New data indexed, tell the g3-reader the catalog changed.
+                if changed:
+                    store.bump_catalog(cur)
+                    changed = 0
+                cnx.commit()
+
+            if time.time() - t_report > 10 or i == len(tasks):
+                t_report = time.time()
+                rate = i / max(t_report - t_start, 1e-6)
+                print("Scanned {}/{} files, {:.1f} files/s, ~{:.0f} s remaining".format(
+                    i, len(tasks), rate, (len(tasks) - i) / rate))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        cur.close()
+        cnx.close()
+
+
+def watch_directory(directory, store, summary_directory=None, workers=1,
+                    interval=3600):
+    """Watch a directory with inotify, indexing .g3 files as soon as they are
+    closed after writing.
+
+    A full scan_directory pass is made on startup, and every interval seconds
+    after that, to catch anything the watch missed. Requires the
+    inotify_simple package, and Linux.
 
-    # print("Queried for fields:", fields) # debug
+    Parameters
+    ----------
+    directory : str
+        the top level directory to watch
+    store : sisock.index.IndexStore
+        index to record the files in
+    summary_directory : str
+        directory to write summary files to, see write_summary.
+    workers : int
+        number of worker processes to read files with
+    interval : float
+        time between full scans, in seconds
 
-    for field_name, description in fields:
-        # Create our timeline names based on the feed
-        _field_name = field_name
+    """
+    from inotify_simple import INotify, flags
 
-        # Actually using for both timeline and field names, as each field
-        # is timestamped independently anyway, and _field_name is not
-        # guarenteed to be unique between feeds (i.e. there is a "Channel
-        # 01" feed on every Lakeshore).
-        _timeline_name = description + '.' + _field_name
+    inotify = INotify()
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    watches = {}
 
-        cur.execute("INSERT IGNORE \
-                     INTO description \
-                         (description) \
-                     VALUES \
-                         (%s)", (_timeline_name,))
+    def add_watches(path):
+        """Watch path and all directories below it, returning any files
+        already within them."""
+        found = []
+        for root, _, _file in os.walk(path):
+            watches[inotify.add_watch(root, mask)] = root
+            found.extend((root, g3) for g3 in _file)
+        return found
 
-    # Close DB connection
-    cnx.commit()
-    cur.close()
-    cnx.close()
+    add_watches(directory)
+    print("Watching {} directories under {}".format(len(watches), directory))
 
-    total_time = time.time() - t
-    print("Total Time:", total_time)
+    next_full_scan = 0
+    while True:
+        if time.time() >= next_full_scan:
+            scan_directory(directory, store, summary_directory, workers=workers)
+            next_full_scan = time.time() + interval
+
+        # Wait for events, up to the next full scan, gathering any which
+        # arrive in quick succession.
+        timeout = max(next_full_scan - time.time(), 0)
+        events = inotify.read(timeout=int(timeout * 1000), read_delay=1000)
+
+        pending = set()
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                print("inotify queue overflowed, running a full scan")
+                next_full_scan = 0
+                continue
+
+            root = watches.get(event.wd)
+            if event.mask & flags.IGNORED:
+                watches.pop(event.wd, None)
+                continue
+            if root is None:
+                continue
+
+            if event.mask & flags.ISDIR:
+                # New directory, files may have been written before the
+                # watch was added.
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    pending.update(add_watches(os.path.join(root, event.name)))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                pending.add((root, event.name))
+
+        if pending and next_full_scan:
+            scan_directory(directory, store, summary_directory,
+                           workers=workers, files=sorted(pending))
 
 
 if __name__ == "__main__":
-    # Check variables setup when creating the Docker container.
-    required_env = ['SQL_HOST', 'SQL_USER', 'SQL_PASSWD', 'SQL_DB']
-
-    for var in required_env:
-        try:
-            environ[var]
-        except KeyError:
-            print("Required environment variable {} is missing. \
-                  Check your environment setup and try again.".format(var))
-
-    # SQL Config
-    # User/password just for development purposes, obviously change in production.
-    SQL_CONFIG = {'host': environ['SQL_HOST'],
-                  'user': environ['SQL_USER'],
-                  'passwd': environ['SQL_PASSWD'],
-                  'db': environ['SQL_DB']}
-
-    init_tables(SQL_CONFIG)
+    # The index is stored in MySQL, configured by the SQL_* environment
+    # variables, unless INDEX_BACKEND is "sqlite".
+    INDEX = sisock.index.from_environ(environ)
+    INDEX.init_tables()
+
+    # Index files as they're written, with a full scan every SCAN_INTERVAL.
+    if environ.get('SCAN_MODE', 'poll') == 'watch':
+        watch_directory(environ['DATA_DIRECTORY'], INDEX,
+                        environ.get('SUMMARY_DIRECTORY'),
+                        workers=int(environ.get('SCAN_WORKERS', 1)),
+                        interval=int(environ['SCAN_INTERVAL']))
 
     while True:
-        scan_directory(environ['DATA_DIRECTORY'], SQL_CONFIG)
-        build_description_table(SQL_CONFIG)
+        scan_directory(environ['DATA_DIRECTORY'], INDEX,
+                       environ.get('SUMMARY_DIRECTORY'),
+                       workers=int(environ.get('SCAN_WORKERS', 1)))
         print('sleeping for:', environ['SCAN_INTERVAL'])
         time.sleep(int(environ['SCAN_INTERVAL']))
@@ -1,4 +1,6 @@
 from . import base
+from . import index
+from . import summary
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -0,0 +1,796 @@
+"""
+Index of g3 files on disk (:mod:`sisock.index`)
+
+.. currentmodule:: sisock.index
+
+The g3-file-scanner records which feeds and fields each g3 file contains, the
+time span of each field and the byte offset of each data frame in an index,
+which the g3-reader then queries to find the data it needs. The index can be
+stored by either of two backends, which share the same interface.
+
+Classes
+=======
+.. autosummary::
+    sisock.index.IndexStore
+    sisock.index.MySQLIndex
+    sisock.index.SQLiteIndex
+
+Functions
+=========
+.. autosummary::
+    sisock.index.from_environ
+
+Constants
+=========
+:const:`MIGRATIONS`
+    Statements to upgrade an index written by an earlier version of the
+    g3-file-scanner, keyed by the schema version they upgrade to, as (table,
+    statement) pairs. Statements on a table which was only just created, with
+    the current schema, are skipped.
+:const:`SCHEMA_VERSION`
+    Schema version of a newly created index.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+MIGRATIONS = {
+    # Store field start/end as unix timestamps, rather than as local time
+    # DATETIMEs, and index them for range queries. Existing values were
+    # written in the container's timezone, UTC.
+    2: [(None, "SET time_zone = '+00:00'"),
+        ("fields", "ALTER TABLE fields \
+                        ADD COLUMN start_epoch DOUBLE, \
+                        ADD COLUMN end_epoch DOUBLE"),
+        ("fields", "UPDATE fields \
+                        SET start_epoch = UNIX_TIMESTAMP(start), \
+                            end_epoch = UNIX_TIMESTAMP(end)"),
+        ("fields", "ALTER TABLE fields DROP COLUMN start, DROP COLUMN end"),
+        ("fields", "ALTER TABLE fields \
+                        CHANGE start_epoch start DOUBLE, \
+                        CHANGE end_epoch end DOUBLE"),
+        ("fields", "CREATE INDEX index_field_time ON fields (`field`, `start`, `end`)"),
+        ("fields", "CREATE INDEX index_time ON fields (`start`, `end`)")],
+    # Record where to resume reading files which are still being written.
+    # Files already in the table were read to the end.
+    3: [("files", "ALTER TABLE files ADD COLUMN byte_offset BIGINT NOT NULL DEFAULT 0"),
+        ("files", "UPDATE files SET byte_offset = size")],
+    # Per file statistics of each field. Existing files are indexed again to
+    # fill them in.
+    4: [("fields", "ALTER TABLE fields ADD COLUMN samples BIGINT NOT NULL DEFAULT 0"),
+        ("fields", "ALTER TABLE fields ADD COLUMN nans BIGINT NOT NULL DEFAULT 0"),
+        ("fields", "ALTER TABLE fields ADD COLUMN min_value DOUBLE"),
+        ("fields", "ALTER TABLE fields ADD COLUMN max_value DOUBLE"),
+        ("fields", "ALTER TABLE fields ADD COLUMN total DOUBLE NOT NULL DEFAULT 0"),
+        ("files", "DELETE FROM files"),
+        ("feeds", "UPDATE feeds SET scanned=0")],
+    # Index frames by time, to find those of a feed within a time range.
+    5: [("frames", "CREATE INDEX index_frame_time ON frames (`feed_id`, `start`, `end`)")],
+    # The field list is built from the fields table, the description table
+    # is no longer kept.
+    6: [("description", "DROP TABLE IF EXISTS description")],
+    # Record the catalog version at which the fields of each feed last
+    # changed, and at which any were last removed, so the g3-reader can
+    # refresh only the field lifetimes which changed.
+    7: [("feeds", "ALTER TABLE feeds ADD COLUMN catalog_version INT NOT NULL DEFAULT 0"),
+        ("feeds", "CREATE INDEX index_feed_catalog ON feeds (`catalog_version`)"),
+        ("catalog", "ALTER TABLE catalog ADD COLUMN cleared INT NOT NULL DEFAULT 0")],
+}
+
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+def _split_names(names):
+    """Split sisock field names into feed descriptions and field names, at
+    the last '.', as field names within a feed contain none.
+
+    Returns
+    -------
+    tuple
+        sorted lists of the distinct descriptions and field names, to filter
+        on with indexes, and the set of (description, field) pairs, to then
+        pick out the exact fields asked for.
+
+    """
+    pairs = set(tuple(name.rsplit('.', 1)) for name in names if '.' in name)
+    return (sorted(set(d for d, _ in pairs)), sorted(set(f for _, f in pairs)),
+            pairs)
+
+
+def _placeholders(values):
+    """%s placeholders for the values in an IN clause."""
+    return "(" + ", ".join(["%s"] * len(values)) + ")"
+
+
+class IndexStore(object):
+    """Interface to the g3 file index, independent of where it is stored.
+
+    Statements are written for MySQL, with %s placeholders, and subclasses
+    override the attributes and methods below where their SQL differs.
+    Methods which touch the index take a cursor, from a connection made with
+    :meth:`connect`, so that the caller decides when to commit.
+
+    """
+    #: Column definition for an auto incrementing integer primary key.
+    auto_increment = "INT NOT NULL AUTO_INCREMENT PRIMARY KEY"
+
+    #: INSERT which silently skips rows violating a unique index.
+    insert_ignore = "INSERT IGNORE"
+
+    #: Clause completing an INSERT into fields, widening the start/end times
+    #: of any existing row and adding to its statistics.
+    upsert_fields = "ON DUPLICATE KEY UPDATE \
+                         start=LEAST(start, VALUES(start)), \
+                         end=GREATEST(end, VALUES(end)), \
+                         samples=samples + VALUES(samples), \
+                         nans=nans + VALUES(nans), \
+                         min_value=LEAST(COALESCE(min_value, VALUES(min_value)), \
+                                         COALESCE(VALUES(min_value), min_value)), \
+                         max_value=GREATEST(COALESCE(max_value, VALUES(max_value)), \
+                                            COALESCE(VALUES(max_value), max_value)), \
+                         total=total + VALUES(total)"
+
+    #: Clause completing an INSERT into files, replacing any existing row.
+    upsert_files = "ON DUPLICATE KEY UPDATE \
+                        size=VALUES(size), \
+                        mtime=VALUES(mtime), \
+                        byte_offset=VALUES(byte_offset)"
+
+    def connect(self):
+        """Open a DB-API connection to the index.
+
+        Returns
+        -------
+        connection
+            Connection, to be closed by the caller.
+
+        """
+        raise NotImplementedError
+
+    def tables(self, cur):
+        """List the names of the tables in the index."""
+        raise NotImplementedError
+
+    def _sql(self, statement):
+        """Translate a statement written for MySQL to this backend."""
+        return statement
+
+    def execute(self, cur, statement, params=()):
+        """Execute a statement written with %s placeholders."""
+        cur.execute(self._sql(statement), params)
+
+    def executemany(self, cur, statement, seq_params):
+        """Execute a statement written with %s placeholders for each set of
+        parameters."""
+        cur.executemany(self._sql(statement), seq_params)
+
+    def init_tables(self):
+        """Create any missing tables, and upgrade an existing index to the
+        current schema."""
+        cnx = self.connect()
+        cur = cnx.cursor()
+
+        tables = self.tables(cur)
+        print(tables)
+
+        # Tables created here already have the current schema, so are left
+        # alone by the migrations below.
+        created = set()
+
+        if "feeds" not in tables and "fields" not in tables:
+            print("Initializing feeds and fields tables.")
+            created.update(["feeds", "fields"])
+            self.execute(cur, "CREATE TABLE feeds \
+                                   (id %s, \
+                                    filename varchar(255), \
+                                    path varchar(255), \
+                                    prov_id INT, \
+                                    description varchar(255), \
+                                    scanned BOOL NOT NULL DEFAULT 0, \
+                                    catalog_version INT NOT NULL DEFAULT 0)"
+                         % self.auto_increment)
+            self.execute(cur, "CREATE UNIQUE INDEX feed_index ON feeds (`filename`, `prov_id`)")
+            self.execute(cur, "CREATE INDEX index_feed_catalog ON feeds (`catalog_version`)")
+            self.execute(cur, "CREATE TABLE fields \
+                                   (feed_id INT NOT NULL, \
+                                    field varchar(255), \
+                                    start DOUBLE, \
+                                    end DOUBLE, \
+                                    samples BIGINT NOT NULL DEFAULT 0, \
+                                    nans BIGINT NOT NULL DEFAULT 0, \
+                                    min_value DOUBLE, \
+                                    max_value DOUBLE, \
+                                    total DOUBLE NOT NULL DEFAULT 0)")
+            self.execute(cur, "CREATE UNIQUE INDEX index_field ON fields (`feed_id`, `field`)")
+            self.execute(cur, "CREATE INDEX index_field_time ON fields (`field`, `start`, `end`)")
+            self.execute(cur, "CREATE INDEX index_time ON fields (`start`, `end`)")
+
+        if "frames" not in tables:
+            # Byte offsets of each HK data frame, start/end as unix timestamps.
+            print("Initializing frames table.")
+            created.add("frames")
+            self.execute(cur, "CREATE TABLE frames \
+                                   (feed_id INT NOT NULL, \
+                                    byte_offset BIGINT NOT NULL, \
+                                    start DOUBLE, \
+                                    end DOUBLE, \
+                                    fields TEXT)")
+            self.execute(cur, "CREATE UNIQUE INDEX index_frame ON frames (`feed_id`, `byte_offset`)")
+            self.execute(cur, "CREATE INDEX index_frame_time ON frames (`feed_id`, `start`, `end`)")
+
+        if "files" not in tables:
+            # Size and mtime of each file when last scanned, so unchanged
+            # files can be skipped, and the byte offset reading got up to.
+            print("Initializing files table.")
+            created.add("files")
+            self.execute(cur, "CREATE TABLE files \
+                                   (path varchar(255) NOT NULL, \
+                                    filename varchar(255) NOT NULL, \
+                                    size BIGINT NOT NULL, \
+                                    mtime DOUBLE NOT NULL, \
+                                    byte_offset BIGINT NOT NULL DEFAULT 0)")
+            self.execute(cur, "CREATE UNIQUE INDEX index_file ON files (`path`, `filename`)")
+
+        if "catalog" not in tables:
+            # Version number bumped whenever new data is indexed, so the
+            # g3-reader knows to refresh its cached field list, and the
+            # version at which fields were last removed from the index.
+            print("Initializing catalog table.")
+            created.add("catalog")
+            self.execute(cur, "CREATE TABLE catalog \
+                                   (version INT NOT NULL, \
+                                    cleared INT NOT NULL DEFAULT 0)")
+            self.execute(cur, "INSERT INTO catalog (version) VALUES (0)")
+
+        # Tables from before schema versioning are version 1.
+        if "schema_version" not in tables:
+            version = 1 if "fields" in tables else SCHEMA_VERSION
+            self.execute(cur, "CREATE TABLE schema_version (version INT NOT NULL)")
+            self.execute(cur, "INSERT INTO schema_version (version) VALUES (%s)",
+                         (version,))
+
+        cnx.commit()
+
+        self.execute(cur, "SELECT version FROM schema_version")
+        version = cur.fetchone()[0]
+
+        for _version in sorted(MIGRATIONS):
+            if _version <= version:
+                continue
+            print("Migrating DB schema to version {}".format(_version))
+            for table, statement in MIGRATIONS[_version]:
+                if table not in created:
+                    self.execute(cur, statement)
+            self.execute(cur, "UPDATE schema_version SET version=%s", (_version,))
+            cnx.commit()
+
+        cur.close()
+        cnx.close()
+
+    def file_states(self, cur):
+        """Size and mtime of every file as it was when last scanned, and the
+        byte offset just past the last frame read from it.
+
+        Returns
+        -------
+        dict
+            Dictionary with (path, filename) as keys and (size, mtime,
+            byte_offset) as values.
+
+        """
+        self.execute(cur, "SELECT path, filename, size, mtime, byte_offset FROM files")
+        return {(r, f): (size, mtime, offset)
+                for r, f, size, mtime, offset in cur.fetchall()}
+
+    def update_file_state(self, cur, path, filename, size, mtime, byte_offset):
+        """Record the size and mtime of a file that was read, and the byte
+        offset just past the last frame read from it."""
+        self.execute(cur, "INSERT INTO files \
+                               (path, filename, size, mtime, byte_offset) \
+                           VALUES (%s, %s, %s, %s, %s) " + self.upsert_files,
+                     (path, filename, size, mtime, byte_offset))
+
+    def mark_unscanned(self, cur, path, filename):
+        """Flag the feeds of a file as needing to be indexed again."""
+        self.execute(cur, "UPDATE feeds \
+                           SET scanned=0 \
+                           WHERE filename=%s \
+                           AND path=%s", (filename, path))
+
+    def clear_file(self, cur, path, filename):
+        """Remove the fields and frames of a file from the index, so that it
+        can be indexed again from the start.
+
+        Field lifetimes can shrink as a result, so the catalog records that
+        fields were removed in the next version, see :meth:`catalog_cleared`.
+        """
+        for table in ['fields', 'frames']:
+            self.execute(cur, "DELETE FROM " + table + " \
+                               WHERE feed_id IN (SELECT id \
+                                                 FROM feeds \
+                                                 WHERE filename=%s \
+                                                 AND path=%s)", (filename, path))
+        self.execute(cur, "UPDATE catalog SET cleared = version + 1")
+        self.mark_unscanned(cur, path, filename)
+
+    def mark_scanned(self, cur, path, filename):
+        """Flag the feeds of a file as completely indexed."""
+        self.execute(cur, "UPDATE feeds \
+                           SET scanned=1 \
+                           WHERE filename=%s \
+                           AND path=%s", (filename, path))
+
+    def providers(self, cur, path, filename):
+        """The feeds already indexed for a file.
+
+        Returns
+        -------
+        dict
+            Dictionary with prov_id as keys and description as values.
+
+        """
+        self.execute(cur, "SELECT prov_id, description \
+                           FROM feeds \
+                           WHERE filename=%s \
+                           AND path=%s", (filename, path))
+        return dict(cur.fetchall())
+
+    def write_file(self, cur, path, filename, feeds, field_stats, frames):
+        """Write everything gathered from a file to the index, with one
+        statement per table.
+
+        Field start/end times are upserted, only ever widening any times
+        already in the index, and field statistics are added to those already
+        in the index, so that a file can be written in parts as it is read.
+        Feeds whose fields changed are marked with the next catalog version,
+        see :meth:`field_lifetimes`, so the catalog should be bumped before
+        committing.
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor from a connection made with :meth:`connect`
+        path : str
+            The pathname of the file.
+        filename : str
+            The basename of the g3 file.
+        feeds : set
+            (prov_id, description) of each feed in the file.
+        field_stats : dict
+            Dictionary with (prov_id, field) as keys and (start, end,
+            samples, nans, min, max, sum) as values, with start/end as unix
+            times, and min/max None if there were no numeric samples.
+        frames : list
+            (prov_id, byte_offset, start, end, fields) of each data frame.
+
+        Returns
+        -------
+        int
+            Number of rows inserted or changed.
+
+        """
+        changed = 0
+
+        # Each file can (and probably will) contain more than one feed
+        self.executemany(cur, self.insert_ignore + " \
+                              INTO feeds \
+                                  (filename, path, prov_id, description) \
+                              VALUES \
+                                  (%s, %s, %s, %s)",
+                         [(filename, path, prov_id, description)
+                          for prov_id, description in feeds])
+        changed += max(cur.rowcount, 0)
+
+        # Get IDs for each of the file's feeds, skipping those already
+        # scanned.
+        self.execute(cur, "SELECT prov_id, id, scanned \
+                           FROM feeds \
+                           WHERE filename=%s", (filename,))
+        known = set()
+        feed_ids = {}
+        for prov_id, feed_id, scanned in cur.fetchall():
+            known.add(prov_id)
+            if not scanned:
+                feed_ids[prov_id] = feed_id
+
+        for prov_id in set(k[0] for k in field_stats) | set(k[0] for k in frames):
+            if prov_id not in known:
+                raise Exception("%s is not in feed database, something went wrong."
+                                % (filename))
+
+        field_rows = []
+        for (prov_id, field), stats in field_stats.items():
+            if prov_id in feed_ids:
+                field_rows.append((feed_ids[prov_id], field) + tuple(stats))
+
+        print("Upserting times and statistics for {} fields in {}/{}".format(
+            len(field_rows), path, filename))
+        self.executemany(cur, "INSERT \
+                              INTO fields \
+                                  (feed_id, field, start, end, samples, nans, \
+                                   min_value, max_value, total) \
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                         + self.upsert_fields, field_rows)
+        if field_rows and cur.rowcount:
+            changed += max(cur.rowcount, 0)
+            ids = sorted(set(row[0] for row in field_rows))
+            self.execute(cur, "UPDATE feeds \
+                               SET catalog_version = (SELECT version + 1 FROM catalog) \
+                               WHERE id IN " + _placeholders(ids), ids)
+
+        self.executemany(cur, self.insert_ignore + " \
+                              INTO frames \
+                                  (feed_id, byte_offset, start, end, fields) \
+                              VALUES (%s, %s, %s, %s, %s)",
+                         [(feed_ids[prov_id], offset, start, end, json.dumps(fields))
+                          for prov_id, offset, start, end, fields in frames
+                          if prov_id in feed_ids])
+        changed += max(cur.rowcount, 0)
+
+        return changed
+
+    def bump_catalog(self, cur):
+        """Tell the g3-reader that new data has been indexed."""
+        self.execute(cur, "UPDATE catalog SET version = version + 1")
+
+    def catalog_version(self, cur):
+        """Current catalog version, see :meth:`bump_catalog`."""
+        self.execute(cur, "SELECT version FROM catalog")
+        return cur.fetchone()[0]
+
+    def catalog_cleared(self, cur):
+        """Catalog version at which fields were last removed from the index,
+        after which field lifetimes must be built again in full."""
+        self.execute(cur, "SELECT cleared FROM catalog")
+        return cur.fetchone()[0]
+
+    def file_list(self, cur, start, end, fields=None, value_range=None):
+        """Build the list of files with fields within a given start/end
+        range.
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor from a connection made with :meth:`connect`
+        start : float
+            unixtime stamp for start time
+        end : float
+            unixtime stamp for end time
+        fields : list
+            If given, only files containing at least one of these sisock
+            field names are listed.
+        value_range : tuple
+            If given, (low, high), only files where a field has values within
+            this range are listed.
+
+        Returns
+        -------
+        list
+            sorted list of complete file paths
+
+        """
+        statement = "SELECT DISTINCT E.path, E.filename, E.description, F.field \
+                     FROM feeds E, fields F \
+                     WHERE F.feed_id = E.id \
+                     AND F.end > %s \
+                     AND F.start < %s"
+        params = [start, end]
+
+        # Filtered on the field and description columns, so the field time
+        # index is used, then on the exact fields asked for.
+        pairs = None
+        if fields is not None:
+            descriptions, names, pairs = _split_names(fields)
+            if not pairs:
+                return []
+            statement += " AND F.field IN " + _placeholders(names) \
+                + " AND E.description IN " + _placeholders(descriptions)
+            params.extend(names)
+            params.extend(descriptions)
+
+        if value_range is not None:
+            # Rows without statistics can't be ruled out.
+            statement += " AND (F.samples = 0 \
+                                OR (F.max_value >= %s AND F.min_value <= %s))"
+            params.extend(value_range)
+
+        self.execute(cur, statement, params)
+
+        return sorted(set(os.path.join(path, _file)
+                          for path, _file, description, field in cur.fetchall()
+                          if pairs is None or (description, field) in pairs))
+
+    def field_stats(self, cur, fields, start, end):
+        """Get the statistics of fields in each file with data within a given
+        start/end range.
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor from a connection made with :meth:`connect`
+        fields : list
+            sisock field names
+        start : float
+            unixtime stamp for start time
+        end : float
+            unixtime stamp for end time
+
+        Returns
+        -------
+        list
+            list of (field, start, end, samples, nans, min, max, sum) tuples,
+            one per field per file, covering the whole of each file. min and
+            max are None if there were no numeric samples. Files indexed
+            before statistics were recorded are left out.
+
+        """
+        descriptions, names, pairs = _split_names(fields)
+        if not pairs:
+            return []
+
+        self.execute(cur, "SELECT E.description, F.field, F.start, F.end, \
+                                  F.samples, F.nans, F.min_value, F.max_value, F.total \
+                           FROM fields F, feeds E \
+                           WHERE F.feed_id = E.id \
+                           AND F.end > %s \
+                           AND F.start < %s \
+                           AND F.samples > 0 \
+                           AND F.field IN " + _placeholders(names) + " \
+                           AND E.description IN " + _placeholders(descriptions),
+                     [start, end] + names + descriptions)
+
+        return [(description + '.' + field,) + tuple(row)
+                for description, field, *row in cur.fetchall()
+                if (description, field) in pairs]
+
+    def field_lifetimes(self, cur, since=None):
+        """Build the first and last sample time of every field in the index.
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor from a connection made with :meth:`connect`
+        since : int
+            If given, a catalog version, only the feeds whose fields changed
+            after it are included. As times are only ever widened, merging
+            these into lifetimes built at that version brings them up to
+            date, unless fields were removed since, see
+            :meth:`catalog_cleared`.
+
+        Returns
+        -------
+        dict
+            Dictionary with the sisock field name as keys, and a tuple of
+            (first, last) unix timestamps as values.
+
+        """
+        statement = "SELECT E.description, F.field, MIN(F.start), MAX(F.end) \
+                     FROM fields F, feeds E \
+                     WHERE F.feed_id = E.id"
+        params = []
+        if since is not None:
+            statement += " AND E.catalog_version > %s"
+            params.append(since)
+        self.execute(cur, statement + " GROUP BY E.description, F.field", params)
+
+        return {description + '.' + field: (first, last)
+                for description, field, first, last in cur.fetchall()}
+
+    def frame_index(self, cur, start, end, fields=None):
+        """Build an index of the data frames within a given start/end range.
+
+        Files without any entries in the frames table (i.e. scanned before
+        the table existed) do not appear in the index and must be read in
+        full. Files which are indexed, but have no frames in the range, have
+        an empty list.
+
+        Parameters
+        ----------
+        cur : cursor
+            cursor from a connection made with :meth:`connect`
+        start : float
+            unixtime stamp for start time
+        end : float
+            unixtime stamp for end time
+        fields : list
+            If given, only the frames of feeds containing at least one of
+            these sisock field names are listed.
+
+        Returns
+        -------
+        dict
+            Dictionary with the complete file path as keys, and a list of
+            (byte_offset, description, start, end, fields) tuples, one per
+            frame, as values. fields are the full sisock field names.
+
+        """
+        # Feeds with the fields in the range, found with the field time
+        # index.
+        statement = "SELECT DISTINCT E.id, E.path, E.filename, E.description \
+                     FROM fields F, feeds E \
+                     WHERE F.feed_id = E.id \
+                     AND F.end > %s \
+                     AND F.start < %s"
+        params = [start, end]
+        if fields is not None:
+            descriptions, names, pairs = _split_names(fields)
+            if not pairs:
+                return {}
+            statement += " AND F.field IN " + _placeholders(names) \
+                + " AND E.description IN " + _placeholders(descriptions)
+            params.extend(names)
+            params.extend(descriptions)
+        self.execute(cur, statement, params)
+        feeds = {feed_id: (os.path.join(path, _file), description)
+                 for feed_id, path, _file, description in cur.fetchall()}
+
+        frame_index = {}
+        ids = sorted(feeds)
+        # Chunked to stay within the backends' limits on parameters.
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+
+            # Feeds with any frames indexed.
+            self.execute(cur, "SELECT DISTINCT feed_id \
+                               FROM frames \
+                               WHERE feed_id IN " + _placeholders(chunk), chunk)
+            for feed_id, in cur.fetchall():
+                frame_index.setdefault(feeds[feed_id][0], [])
+
+            self.execute(cur, "SELECT feed_id, byte_offset, start, end, fields \
+                               FROM frames \
+                               WHERE feed_id IN " + _placeholders(chunk) + " \
+                               AND end >= %s \
+                               AND start <= %s", chunk + [start, end])
+            for feed_id, offset, _start, _end, _fields in cur.fetchall():
+                filename, description = feeds[feed_id]
+                _fields = [description + '.' + f for f in json.loads(_fields)]
+                frame_index[filename].append((offset, description, _start, _end, _fields))
+
+        return frame_index
+
+
+class MySQLIndex(IndexStore):
+    """Index stored in a MySQL or MariaDB server.
+
+    Parameters
+    ----------
+    config : dict
+        SQL config for the DB connection, with host, user, passwd and db
+        keys.
+    pool_size : int
+        If given, connections are drawn from a pool of this size, for use
+        from several threads.
+
+    """
+    def __init__(self, config, pool_size=None):
+        self.config = config
+        self.pool_size = pool_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def connect(self):
+        # Imported here, so that mysql-connector is only required when used.
+        import mysql.connector
+        import mysql.connector.pooling
+
+        if self.pool_size is None:
+            return mysql.connector.connect(host=self.config['host'],
+                                           user=self.config['user'],
+                                           passwd=self.config['passwd'],
+                                           db=self.config['db'])
+
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="sisock_index",
+                    pool_size=self.pool_size,
+                    host=self.config['host'],
+                    user=self.config['user'],
+                    passwd=self.config['passwd'],
+                    db=self.config['db'])
+        return self._pool.get_connection()
+
+    def tables(self, cur):
+        cur.execute("SHOW TABLES")
+        return [row[0] for row in cur.fetchall()]
+
+
+class SQLiteIndex(IndexStore):
+    """Index stored in an embedded SQLite database file.
+
+    The database is put in WAL mode, so the g3-reader can query it while the
+    g3-file-scanner writes to it. The file must be on a local filesystem, in
+    a directory writable by both.
+
+    Parameters
+    ----------
+    path : str
+        path of the database file
+    timeout : float
+        seconds to wait for another connection's lock before giving up
+
+    """
+    auto_increment = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    insert_ignore = "INSERT OR IGNORE"
+    upsert_fields = "ON CONFLICT (feed_id, field) DO UPDATE SET \
+                         start=MIN(start, excluded.start), \
+                         end=MAX(end, excluded.end), \
+                         samples=samples + excluded.samples, \
+                         nans=nans + excluded.nans, \
+                         min_value=MIN(COALESCE(min_value, excluded.min_value), \
+                                       COALESCE(excluded.min_value, min_value)), \
+                         max_value=MAX(COALESCE(max_value, excluded.max_value), \
+                                       COALESCE(excluded.max_value, max_value)), \
+                         total=total + excluded.total"
+    upsert_files = "ON CONFLICT (path, filename) DO UPDATE SET \
+                        size=excluded.size, \
+                        mtime=excluded.mtime, \
+                        byte_offset=excluded.byte_offset"
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+    def connect(self):
+        cnx = sqlite3.connect(self.path, timeout=self.timeout)
+        # Safe from corruption in WAL mode, only the last commits can be lost
+        # on power failure.
+        cnx.execute("PRAGMA synchronous=NORMAL")
+        return cnx
+
+    def tables(self, cur):
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return [row[0] for row in cur.fetchall()]
+
+    def _sql(self, statement):
+        return statement.replace('%s', '?')
+
+    def init_tables(self):
+        # WAL mode is stored in the database file, so only needs setting
+        # once.
+        cnx = self.connect()
+        cnx.execute("PRAGMA journal_mode=WAL")
+        cnx.close()
+        super(SQLiteIndex, self).init_tables()
+
+
+def from_environ(environ, pool_size=None):
+    """Build the index configured by environment variables.
+
+    INDEX_BACKEND selects the backend, either "mysql" (the default), which is
+    configured with SQL_HOST, SQL_USER, SQL_PASSWD and SQL_DB, or "sqlite",
+    which stores the index in the file at INDEX_PATH.
+
+    Parameters
+    ----------
+    environ : dict
+        environment variables, i.e. os.environ
+    pool_size : int
+        size of the connection pool, for the MySQL backend
+
+    Returns
+    -------
+    IndexStore
+
+    """
+    backend = environ.get('INDEX_BACKEND', 'mysql')
+
+    if backend == 'sqlite':
+        return SQLiteIndex(environ['INDEX_PATH'])
+
+    if backend != 'mysql':
+        raise ValueError("Unknown INDEX_BACKEND {}".format(backend))
+
+    # Check variables setup when creating the Docker container.
+    for var in ['SQL_HOST', 'SQL_USER', 'SQL_PASSWD', 'SQL_DB']:
+        if var not in environ:
+            print("Required environment variable {} is missing. \
+                  Check your environment setup and try again.".format(var))
+
+    return MySQLIndex({'host': environ['SQL_HOST'],
+                       'user': environ['SQL_USER'],
+                       'passwd': environ['SQL_PASSWD'],
+                       'db': environ['SQL_DB']}, pool_size=pool_size)
@@ -0,0 +1,78 @@
+"""
+Summaries of g3 files (:mod:`sisock.summary`)
+
+.. currentmodule:: sisock.summary
+
+The g3-file-scanner can write a summary of each g3 file, holding the minimum,
+maximum, mean and count of each field in bins of several widths, which the
+g3-reader then serves in place of the raw data for zoomed out queries. Both
+use the definitions here, so the files written match what is read.
+
+Functions
+=========
+.. autosummary::
+    sisock.summary.summary_path
+    sisock.summary.combine_rollups
+
+Constants
+=========
+:const:`LEVELS`
+    Widths, in seconds, of the bins in each summary file, finest first. Each
+    level must evenly divide the next.
+:const:`STATS`
+    Statistics stored for each field at each level, under the key
+    "<level>/<field>/<stat>": the bin start time, and the minimum, maximum,
+    mean and number of samples in the bin.
+"""
+
+import os
+
+import numpy as np
+
+LEVELS = [10, 60, 600, 3600]
+
+STATS = ('t', 'min', 'max', 'mean', 'count')
+
+
+def summary_path(summary_directory, filename):
+    """Location of the summary file for a g3 file.
+
+    The full path of the g3 file is mirrored under summary_directory, so that
+    the g3-reader can find the summary from the path stored in the feeds
+    table.
+
+    """
+    return os.path.join(summary_directory, filename.lstrip(os.sep) + '.npz')
+
+
+def combine_rollups(t, _min, _max, mean, count, width):
+    """Combine time ordered rollups into bins of a given width.
+
+    Raw samples can be passed in as rollups with a count of one.
+
+    Parameters
+    ----------
+    t : numpy.ndarray
+        start time of each input bin, sorted
+    _min, _max, mean, count : numpy.ndarray
+        statistics of each input bin
+    width : float
+        width of the output bins, in seconds. Bins start at multiples of
+        width.
+
+    Returns
+    -------
+    tuple
+        (t, min, max, mean, count) arrays for the output bins.
+
+    """
+    if len(t) == 0:
+        return t, _min, _max, mean, count
+
+    bins = np.floor(t / width) * width
+    idx = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    _count = np.add.reduceat(count, idx)
+    total = np.add.reduceat(mean * count, idx)
+
+    return (bins[idx], np.minimum.reduceat(_min, idx),
+            np.maximum.reduceat(_max, idx), total / _count, _count)
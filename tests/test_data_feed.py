@@ -0,0 +1,291 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'components',
+                                'data_node_servers', 'data_feed'))
+from autobahn.wamp.types import ComponentConfig
+
+from data_feed_server import _Buffer, _DiskBuffer, _Rollup, _downsample, data_feed_server
+
+def test_buffer_extend_evict():
+    buff = _Buffer(capacity=4)
+    for i in range(10):
+        buff.extend([2. * i, 2. * i + 1], {'a': [i, i]})
+    assert len(buff) == 20
+    assert np.array_equal(buff.time, np.arange(20.))
+    assert np.array_equal(buff.data('a'), np.repeat(np.arange(10.), 2))
+
+    buff.evict(15.)
+    assert np.array_equal(buff.time, np.arange(15., 20.))
+    assert np.array_equal(buff.data('a'), [7., 8., 8., 9., 9.])
+
+def test_buffer_new_channel():
+    buff = _Buffer()
+    buff.extend([0., 1.], {'a': [1., 2.]})
+    buff.extend([2.], {'b': [3.]})
+    assert np.array_equal(buff.time, [0., 1., 2.])
+    assert np.array_equal(buff.data('a'), [1., 2., np.nan], equal_nan=True)
+    assert np.array_equal(buff.data('b'), [np.nan, np.nan, 3.], equal_nan=True)
+
+def test_buffer_window():
+    buff = _Buffer()
+    buff.extend(np.arange(20.), {'a': np.arange(20.) * 2})
+    buff.evict(5.)
+    t, (a,) = buff.window(16., 18., ['a'])
+    assert np.array_equal(t, [16., 17., 18.])
+    assert np.array_equal(a, [32., 34., 36.])
+    t, (a,) = buff.window(0., 6.5, ['a'])
+    assert np.array_equal(t, [5., 6.])
+    t, (a,) = buff.window(30., 40., ['a'])
+    assert len(t) == 0 and len(a) == 0
+
+def test_buffer_out_of_order():
+    buff = _Buffer()
+    buff.extend([0., 1., 4., 5.], {'a': [0., 1., 4., 5.]})
+    buff.extend([3., 2., 6.], {'a': [3., 2., 6.]})
+    t, (a,) = buff.window(0., 10., ['a'])
+    assert np.array_equal(t, np.arange(7.))
+    assert np.array_equal(a, np.arange(7.))
+
+def test_downsample_keeps_extremes():
+    t = np.arange(100.)
+    y = np.zeros(100)
+    y[37] = 10.
+    y[38] = -10.
+    _t, (_y,) = _downsample(t, [y], 5)
+
+    assert len(_t) == 20
+    assert np.all(np.diff(_t) > 0)
+    # The spike is kept, maximum then minimum as they occurred.
+    i = np.flatnonzero(_t == 30.)[0]
+    assert np.array_equal(_t[i:i + 2], [30., 39.])
+    assert np.array_equal(_y[i:i + 2], [10., -10.])
+
+def test_downsample_sparse():
+    t = np.array([0., 20., 40.])
+    columns = [np.array([1., 2., 3.])]
+    _t, _columns = _downsample(t, columns, 5)
+    assert _t is t and _columns is columns
+    _t, (_y,) = _downsample(np.empty(0), [np.empty(0)], 5)
+    assert len(_t) == 0
+
+def test_buffer_snapshot_isolation():
+    buff = _Buffer(capacity=4)
+    buff.extend([0., 1., 2.], {'a': [0., 1., 2.]})
+    snapshot = buff.snapshot()
+
+    # Growing the arrays, evicting and adding channels leave it untouched.
+    buff.extend(np.arange(3., 20.), {'a': np.arange(3., 20.), 'b': 1.})
+    buff.evict(10.)
+    t, (a,) = snapshot.window(0., 100., ['a'])
+    assert np.array_equal(t, [0., 1., 2.])
+    assert np.array_equal(a, [0., 1., 2.])
+    assert snapshot.channels == ['a']
+
+def test_buffer_snapshot_out_of_order():
+    buff = _Buffer()
+    buff.extend([0., 1., 4., 5.], {'a': [0., 1., 4., 5.]})
+    snapshot = buff.snapshot()
+
+    # Sorting late samples into place doesn't modify those in the snapshot.
+    buff.extend([3., 2., 6.], {'a': [3., 2., 6.]})
+    t, (a,) = snapshot.window(0., 10., ['a'])
+    assert np.array_equal(t, [0., 1., 4., 5.])
+    assert np.array_equal(a, [0., 1., 4., 5.])
+
+def test_disk_buffer_matches_buffer(tmpdir):
+    disk = _DiskBuffer(str(tmpdir.join('block')), segment_time=10)
+    memory = _Buffer()
+    for i in range(5):
+        t = np.arange(7. * i, 7. * i + 7.)
+        data = {'a': t * 2} if i != 2 else {'a': t * 2, 'b': -t}
+        disk.extend(t, data)
+        memory.extend(t, data)
+
+    assert sorted(disk.channels) == sorted(memory.channels)
+    for start, end in [(0., 100.), (5., 23.), (9.5, 10.5), (50., 60.)]:
+        t, columns = disk.window(start, end, ['a', 'b'])
+        _t, _columns = memory.window(start, end, ['a', 'b'])
+        assert np.array_equal(t, _t)
+        for column, _column in zip(columns, _columns):
+            assert np.array_equal(column, _column, equal_nan=True)
+
+def test_disk_buffer_recovery_after_partial_write(tmpdir):
+    directory = str(tmpdir.join('block'))
+    buff = _DiskBuffer(directory, segment_time=100)
+    buff.extend([0., 1., 2.], {'a': [0., 1., 2.], 'b': [5., 6., 7.]})
+
+    # A sample whose channels were written, but not all of its timestamp,
+    # when the process stopped.
+    segment = os.path.join(directory, sorted(os.listdir(directory))[-1])
+    with open(os.path.join(segment, 'data', 'a'), 'ab') as f:
+        f.write(np.float64(3.).tobytes())
+    with open(os.path.join(segment, 't'), 'ab') as f:
+        f.write(np.float64(3.).tobytes()[:4])
+
+    recovered = _DiskBuffer(directory, segment_time=100)
+    assert sorted(recovered.channels) == ['a', 'b']
+    t, (a, b) = recovered.window(0., 10., ['a', 'b'])
+    assert np.array_equal(t, [0., 1., 2.])
+    assert np.array_equal(a, [0., 1., 2.])
+    assert np.array_equal(b, [5., 6., 7.])
+
+    # Appending carries on from the samples recovered.
+    recovered.extend([3.], {'a': [3.], 'b': [8.]})
+    t, (a, b) = _DiskBuffer(directory, segment_time=100).window(0., 10., ['a', 'b'])
+    assert np.array_equal(t, [0., 1., 2., 3.])
+    assert np.array_equal(a, [0., 1., 2., 3.])
+    assert np.array_equal(b, [5., 6., 7., 8.])
+
+def test_disk_buffer_evict(tmpdir):
+    directory = str(tmpdir.join('block'))
+    buff = _DiskBuffer(directory, segment_time=10)
+    buff.extend(np.arange(50.), {'a': np.arange(50.)})
+    assert len(os.listdir(directory)) == 5
+    snapshot = buff.snapshot()
+
+    buff.evict(25.)
+    # Only whole segments older than the cutoff are deleted, the rest of
+    # the samples before it are hidden.
+    assert len(os.listdir(directory)) == 3
+    t, (a,) = buff.window(0., 100., ['a'])
+    assert np.array_equal(t, np.arange(25., 50.))
+
+    # The snapshot skips segments deleted since it was taken.
+    t, (a,) = snapshot.window(0., 100., ['a'])
+    assert np.array_equal(t, np.arange(20., 50.))
+
+    # Samples older than the last one stored are dropped.
+    buff.extend([10., 60.], {'a': [10., 60.]})
+    t, (a,) = buff.window(0., 100., ['a'])
+    assert np.array_equal(t, np.concatenate((np.arange(25., 50.), [60.])))
+
+def test_disk_buffer_evict_all(tmpdir):
+    directory = str(tmpdir.join('block'))
+    buff = _DiskBuffer(directory, segment_time=10)
+    buff.extend(np.arange(20.), {'a': np.arange(20.)})
+    snapshot = buff.snapshot()
+
+    # New segments after evicting everything don't reuse the names of those
+    # in the snapshot, even after a restart.
+    buff.evict(100.)
+    buff.extend([100.], {'a': [100.]})
+    buff = _DiskBuffer(directory, segment_time=10)
+    buff.extend([120.], {'a': [120.]})
+    assert sorted(os.listdir(directory)) == ['0000000002', '0000000003']
+    t, (a,) = snapshot.window(0., 200., ['a'])
+    assert len(t) == 0
+    t, (a,) = buff.window(0., 200., ['a'])
+    assert np.array_equal(t, [100., 120.])
+
+def _brute_force_rollup(t, y, interval):
+    keys = np.floor(t / interval)
+    rows = []
+    for key in np.unique(keys):
+        _y = y[keys == key]
+        rows.append(((key + 0.5) * interval, _y.min(), _y.max(), _y.mean()))
+    return np.array(rows).T
+
+def test_rollup_intervals():
+    rollup = _Rollup(10, _Buffer())
+    rng = np.random.RandomState(0)
+    t = np.sort(rng.uniform(0., 100., 200))
+    y = rng.normal(size=len(t))
+
+    # Batches ending within an interval, and batches starting past the open
+    # one, both merge with it correctly.
+    for batch in np.split(np.arange(len(t)), [3, 50, 51, 120, 180]):
+        rollup.extend(t[batch], {'a': y[batch]})
+    rollup.extend([105.], {'a': [0.]})
+
+    mid, (_min, _max, mean) = rollup.buffer.window(
+        -np.inf, np.inf, ['a.min', 'a.max', 'a.mean'])
+    expected = _brute_force_rollup(t, y, 10)
+    assert np.allclose(mid, expected[0])
+    assert np.allclose(_min, expected[1])
+    assert np.allclose(_max, expected[2])
+    assert np.allclose(mean, expected[3])
+
+def test_rollup_open_interval():
+    rollup = _Rollup(10, _Buffer())
+    rollup.extend([1., 2.], {'a': [1., 3.]})
+    # The interval stays open until a later sample arrives.
+    assert len(rollup.buffer) == 0
+
+    rollup.extend([5.], {'a': [5.]})
+    assert len(rollup.buffer) == 0
+
+    # Samples entirely past the open interval close it.
+    rollup.extend([25., 26.], {'a': [0., 2.], 'b': [4., 4.]})
+    mid, (_min, _max, mean, b) = rollup.buffer.window(
+        -np.inf, np.inf, ['a.min', 'a.max', 'a.mean', 'b.mean'])
+    assert np.array_equal(mid, [5.])
+    assert np.array_equal(_min, [1.])
+    assert np.array_equal(_max, [5.])
+    assert np.array_equal(mean, [3.])
+    assert np.isnan(b[0])
+
+    # Samples before the open interval are left out.
+    rollup.extend([3., 27., 31.], {'a': [100., 4., 0.]})
+    mid, (_min, _max, mean, b) = rollup.buffer.window(
+        -np.inf, np.inf, ['a.min', 'a.max', 'a.mean', 'b.mean'])
+    assert np.array_equal(mid, [5., 25.])
+    assert np.array_equal(_max, [5., 4.])
+    assert np.array_equal(mean, [3., 2.])
+    assert np.array_equal(b, [np.nan, 4.], equal_nan=True)
+
+def test_rollup_extremes():
+    rollup = _Rollup(10, _Buffer())
+    rollup.extend([1., 2., 11.], {'a': [1., 3., 0.]})
+    t, (a,) = rollup.window(0., 100., ['a'], extremes=True)
+    assert np.array_equal(t, [2.5, 7.5])
+    assert np.array_equal(a, [1., 3.])
+
+def test_server_feeds_kept_apart(tmpdir):
+    def server(feed):
+        return data_feed_server(ComponentConfig('test'), 'test', 'test', feed,
+                                target='LSA22YE', buffer_directory=str(tmpdir))
+
+    s = server('temperatures,diagnostics')
+    now = time.time()
+    for feed, value in [('temperatures', 1.), ('diagnostics', 2.)]:
+        s.extend_data({'block': {'timestamps': [now - 2, now - 1],
+                                 'data': {'channel_01': [value, value]}}},
+                      'LSA22YE', feed)
+    s._publish()
+
+    fields = ['temperatures.channel_01', 'diagnostics.channel_01']
+    data = s._get_data_blocking(fields, now - 10, now)
+    assert data['data'] == {'temperatures.channel_01': [1., 1.],
+                            'diagnostics.channel_01': [2., 2.]}
+    assert sorted(data['timeline']) == ['observatory.LSA22YE.feeds.diagnostics.block',
+                                        'observatory.LSA22YE.feeds.temperatures.block']
+
+    # Both are recovered from disk, and with a single feed it isn't prefixed.
+    assert sorted(server('temperatures,diagnostics').blocks) == sorted(fields)
+    assert sorted(server('temperatures').blocks) == ['channel_01']
+
+def test_server_rollup_tiers():
+    # The first rollup is kept for less than the buffer, so is never used.
+    s = data_feed_server(ComponentConfig('test'), 'test', 'test', 'temperatures',
+                         target='LSA22YE', buffer_time=3600,
+                         rollups=[(60, 1800), (600, 86400)])
+    now = time.time()
+    t = np.arange(now - 2 * 86400, now, 10.)
+    s.extend_data({'block': {'timestamps': t, 'data': {'channel_01': t}}},
+                  'LSA22YE', 'temperatures')
+    s._publish()
+
+    data = s._get_data_blocking(['channel_01'], now - 2 * 86400, now)
+    _t = np.array(data['timeline']['observatory.LSA22YE.block']['t'])
+    assert np.all(np.diff(_t) > 0)
+    # Raw samples for the buffer time, ten minute means for the day before.
+    assert np.all(np.diff(_t[_t > now - 3590]) == 10.)
+    assert _t[0] > now - 86400 and _t[0] < now - 86400 + 600
+    assert np.all(np.diff(_t[_t < now - 4200]) == 600.)
+    # The means of the samples fall in their intervals.
+    y = np.array(data['data']['channel_01'])
+    assert np.all(np.abs(y - _t) <= 300.)
@@ -0,0 +1,214 @@
+import sqlite3
+
+import pytest
+
+import sisock
+
+def _write_index(tmpdir):
+    store = sisock.index.SQLiteIndex(str(tmpdir.join('index.db')))
+    store.init_tables()
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    store.write_file(cur, '/data/15529', 'a.g3',
+                     {(0, 'observatory.LSA22YE')},
+                     {(0, 'channel_01_r'): (10., 20., 4, 1, 1., 3., 6.)},
+                     [(0, 1734, 10., 20., ['channel_01_r'])])
+    store.mark_scanned(cur, '/data/15529', 'a.g3')
+    store.update_file_state(cur, '/data/15529', 'a.g3', 100, 1.5, 90)
+    store.bump_catalog(cur)
+    cnx.commit()
+    cur.close()
+    cnx.close()
+
+    return store
+
+def test_sqlite_index_queries(tmpdir):
+    store = _write_index(tmpdir)
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    assert store.catalog_version(cur) == 1
+    assert 'description' not in store.tables(cur)
+    assert store.file_states(cur) == {('/data/15529', 'a.g3'): (100, 1.5, 90)}
+    assert store.providers(cur, '/data/15529', 'a.g3') == {0: 'observatory.LSA22YE'}
+    assert store.file_list(cur, 15, 30) == ['/data/15529/a.g3']
+    assert store.file_list(cur, 20, 30) == []
+    assert store.file_list(cur, 15, 30, fields=['observatory.LSA22YE.channel_01_t']) == []
+    assert store.file_list(cur, 15, 30, value_range=(3., 5.)) == ['/data/15529/a.g3']
+    assert store.file_list(cur, 15, 30, value_range=(4., 5.)) == []
+    assert store.field_lifetimes(cur) == \
+        {'observatory.LSA22YE.channel_01_r': (10., 20.)}
+    assert store.frame_index(cur, 0, 15) == \
+        {'/data/15529/a.g3': [(1734, 'observatory.LSA22YE', 10., 20.,
+                               ['observatory.LSA22YE.channel_01_r'])]}
+    assert store.frame_index(cur, 0, 15, fields=['observatory.LSA22YE.channel_01_r']) == \
+        store.frame_index(cur, 0, 15)
+    assert store.frame_index(cur, 0, 15, fields=['observatory.LSA22YE.channel_01_t']) == {}
+    cur.close()
+    cnx.close()
+
+def test_sqlite_index_merges_field_stats(tmpdir):
+    store = _write_index(tmpdir)
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    store.mark_unscanned(cur, '/data/15529', 'a.g3')
+    store.write_file(cur, '/data/15529', 'a.g3',
+                     {(0, 'observatory.LSA22YE')},
+                     {(0, 'channel_01_r'): (15., 30., 2, 2, None, None, 0.)}, [])
+    assert store.field_lifetimes(cur) == \
+        {'observatory.LSA22YE.channel_01_r': (10., 30.)}
+    assert store.field_stats(cur, ['observatory.LSA22YE.channel_01_r'], 0, 40) == \
+        [('observatory.LSA22YE.channel_01_r', 10., 30., 6, 3, 1., 3., 6.)]
+
+    store.clear_file(cur, '/data/15529', 'a.g3')
+    assert store.field_lifetimes(cur) == {}
+    cur.close()
+    cnx.close()
+
+def test_sqlite_index_frame_index_in_gap(tmpdir):
+    store = _write_index(tmpdir)
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    store.write_file(cur, '/data/15529', 'b.g3',
+                     {(0, 'observatory.LSA22YE')},
+                     {(0, 'channel_01_r'): (30., 50., 4, 0, 1., 3., 6.)},
+                     [(0, 100, 30., 35., ['channel_01_r']),
+                      (0, 200, 45., 50., ['channel_01_r'])])
+    fields = ['observatory.LSA22YE.channel_01_r']
+    # Indexed, but without frames in the range, so there's nothing to read.
+    assert store.frame_index(cur, 38, 42, fields=fields) == {'/data/15529/b.g3': []}
+    assert store.frame_index(cur, 34, 42, fields=fields) == \
+        {'/data/15529/b.g3': [(100, 'observatory.LSA22YE', 30., 35., fields)]}
+    cur.close()
+    cnx.close()
+
+def test_sqlite_index_exact_fields(tmpdir):
+    store = _write_index(tmpdir)
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    store.write_file(cur, '/data/15529', 'b.g3',
+                     {(0, 'observatory.LSA22Z2')},
+                     {(0, 'channel_02_r'): (10., 20., 4, 0, 1., 3., 6.)}, [])
+    # Descriptions and fields of the names asked for, but crossed.
+    crossed = ['observatory.LSA22YE.channel_02_r', 'observatory.LSA22Z2.channel_01_r']
+    assert store.file_list(cur, 15, 30, fields=crossed) == []
+    assert store.field_stats(cur, crossed, 0, 40) == []
+    assert store.file_list(cur, 15, 30, fields=['observatory.LSA22Z2.channel_02_r']) == \
+        ['/data/15529/b.g3']
+    cur.close()
+    cnx.close()
+
+@pytest.mark.parametrize('files_table', [False, True])
+def test_sqlite_index_upgrade_from_v1(tmpdir, monkeypatch, files_table):
+    # An index as written before schema versioning, with field times stored
+    # as datetimes, and, by later such versions, the state of each file.
+    path = str(tmpdir.join('index.db'))
+    cnx = sqlite3.connect(path)
+    cnx.execute("CREATE TABLE feeds \
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, \
+                      filename varchar(255), \
+                      path varchar(255), \
+                      prov_id INT, \
+                      description varchar(255), \
+                      scanned BOOL NOT NULL DEFAULT 0)")
+    cnx.execute("CREATE UNIQUE INDEX feed_index ON feeds (`filename`, `prov_id`)")
+    cnx.execute("CREATE TABLE fields \
+                     (feed_id INT NOT NULL, \
+                      field varchar(255), \
+                      start DATETIME(6), \
+                      end DATETIME(6))")
+    cnx.execute("CREATE UNIQUE INDEX index_field ON fields (`feed_id`, `field`)")
+    cnx.execute("CREATE TABLE description \
+                     (description varchar(255) NOT NULL PRIMARY KEY)")
+    if files_table:
+        cnx.execute("CREATE TABLE files \
+                         (path varchar(255) NOT NULL, \
+                          filename varchar(255) NOT NULL, \
+                          size BIGINT NOT NULL, \
+                          mtime DOUBLE NOT NULL)")
+        cnx.execute("CREATE UNIQUE INDEX index_file ON files (`path`, `filename`)")
+        cnx.execute("INSERT INTO files VALUES ('/data/15529', 'a.g3', 100, 1.5)")
+    cnx.execute("INSERT INTO feeds (filename, path, prov_id, description, scanned) \
+                 VALUES ('a.g3', '/data/15529', 0, 'observatory.LSA22YE', 1)")
+    cnx.execute("INSERT INTO fields VALUES (1, 'channel_01_r', \
+                 '1970-01-01 00:00:10.000000', '1970-01-01 00:00:20.000000')")
+    cnx.commit()
+    cnx.close()
+
+    # The conversion of field times is written for MySQL, this is its SQLite
+    # equivalent. Later migrations run as they are.
+    monkeypatch.setitem(sisock.index.MIGRATIONS, 2, [
+        ("fields", "ALTER TABLE fields ADD COLUMN start_epoch DOUBLE"),
+        ("fields", "ALTER TABLE fields ADD COLUMN end_epoch DOUBLE"),
+        ("fields", "UPDATE fields \
+                        SET start_epoch = (julianday(start) - 2440587.5) * 86400, \
+                            end_epoch = (julianday(end) - 2440587.5) * 86400"),
+        ("fields", "ALTER TABLE fields DROP COLUMN start"),
+        ("fields", "ALTER TABLE fields DROP COLUMN end"),
+        ("fields", "ALTER TABLE fields RENAME COLUMN start_epoch TO start"),
+        ("fields", "ALTER TABLE fields RENAME COLUMN end_epoch TO end"),
+        ("fields", "CREATE INDEX index_field_time ON fields (`field`, `start`, `end`)"),
+        ("fields", "CREATE INDEX index_time ON fields (`start`, `end`)")])
+
+    store = sisock.index.SQLiteIndex(path)
+    store.init_tables()
+    # Upgrading again does nothing.
+    store.init_tables()
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    store.execute(cur, "SELECT version FROM schema_version")
+    assert cur.fetchone()[0] == sisock.index.SCHEMA_VERSION
+    assert 'description' not in store.tables(cur)
+    assert store.file_states(cur) == {}
+    # Files are indexed again for their statistics, their times are kept
+    # until then.
+    assert store.providers(cur, '/data/15529', 'a.g3') == {0: 'observatory.LSA22YE'}
+    lifetimes = store.field_lifetimes(cur)
+    assert list(lifetimes) == ['observatory.LSA22YE.channel_01_r']
+    assert lifetimes['observatory.LSA22YE.channel_01_r'] == pytest.approx((10., 20.), abs=1e-3)
+    store.write_file(cur, '/data/15529', 'a.g3',
+                     {(0, 'observatory.LSA22YE')},
+                     {(0, 'channel_01_r'): (10., 30., 4, 1, 1., 3., 6.)},
+                     [(0, 1734, 10., 30., ['channel_01_r'])])
+    assert store.frame_index(cur, 25, 40) == \
+        {'/data/15529/a.g3': [(1734, 'observatory.LSA22YE', 10., 30.,
+                               ['observatory.LSA22YE.channel_01_r'])]}
+    cur.close()
+    cnx.close()
+
+def test_sqlite_index_field_lifetimes_since(tmpdir):
+    store = _write_index(tmpdir)
+
+    cnx = store.connect()
+    cur = cnx.cursor()
+    store.write_file(cur, '/data/15529', 'b.g3',
+                     {(0, 'observatory.LSA22Z2')},
+                     {(0, 'channel_02_r'): (30., 40., 4, 0, 1., 3., 6.)}, [])
+    store.bump_catalog(cur)
+    assert store.catalog_version(cur) == 2
+    # Only the feeds whose fields changed after the version given.
+    assert store.field_lifetimes(cur, since=1) == \
+        {'observatory.LSA22Z2.channel_02_r': (30., 40.)}
+    assert store.field_lifetimes(cur, since=2) == {}
+
+    # A file growing changes its feeds again.
+    store.mark_unscanned(cur, '/data/15529', 'a.g3')
+    store.write_file(cur, '/data/15529', 'a.g3',
+                     {(0, 'observatory.LSA22YE')},
+                     {(0, 'channel_01_r'): (20., 25., 1, 0, 1., 1., 1.)}, [])
+    store.bump_catalog(cur)
+    assert store.field_lifetimes(cur, since=2) == \
+        {'observatory.LSA22YE.channel_01_r': (10., 25.)}
+
+    # Removing fields is flagged, for the lifetimes to be built again.
+    assert store.catalog_cleared(cur) == 0
+    store.clear_file(cur, '/data/15529', 'a.g3')
+    store.bump_catalog(cur)
+    assert store.catalog_cleared(cur) == store.catalog_version(cur) == 4
+    cur.close()
+    cnx.close()
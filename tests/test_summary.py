@@ -0,0 +1,26 @@
+import numpy as np
+
+import sisock
+
+def test_combine_rollups_of_samples():
+    t = np.array([0., 5., 12., 19., 31.])
+    y = np.array([1., 3., -2., 4., 7.])
+    rollup = sisock.summary.combine_rollups(t, y, y, y, np.ones(len(t)), width=10)
+    for array, expected in zip(rollup, [[0., 10., 30.], [1., -2., 7.], [3., 4., 7.],
+                                        [2., 1., 7.], [2., 2., 1.]]):
+        assert np.array_equal(array, expected)
+
+def test_combine_rollups_of_rollups():
+    t = np.array([0., 5., 12., 19., 31.])
+    y = np.array([1., 3., -2., 4., 7.])
+    ones = np.ones(len(t))
+    fine = sisock.summary.combine_rollups(t, y, y, y, ones, width=10)
+    # Each level built from the one before matches binning the samples.
+    coarse = sisock.summary.combine_rollups(*fine, width=60)
+    direct = sisock.summary.combine_rollups(t, y, y, y, ones, width=60)
+    for a, b in zip(coarse, direct):
+        assert np.allclose(a, b)
+
+def test_summary_path():
+    assert sisock.summary.summary_path('/summary', '/data/15529/a.g3') == \
+        '/summary/data/15529/a.g3.npz'